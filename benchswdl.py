@@ -0,0 +1,653 @@
+#!/usr/bin/python3
+
+"""********************************************************************
+Description:  Benchmark Software Downloads KPI routines on synthetic data
+
+              Usage: python benchswdl.py run [rows ...] [--out FILE]
+                     python benchswdl.py compare BASELINE [RESULTS] [--threshold PCT]
+                     python benchswdl.py workbook ROWS FILE
+                     python benchswdl.py decode [rows ...]
+                     python benchswdl.py check
+
+              - run:      time each pipeline stage, save results as JSON
+              - compare:  flag stages slower than a saved baseline
+              - workbook: write a synthetic SWDL workbook
+              - decode:   compare decode_filename with the original loop
+              - check:    check the count index, FYQ lookup and record
+                          keys against simple references (exit 1 on failure)
+
+***********************************************************************"""
+
+import os
+import sys
+import json
+import time
+import platform
+from datetime import date, datetime
+
+try:
+    import numpy as np
+    import pandas as pd
+
+except ImportError:
+    print("Please install the python 'pandas' module")
+    sys.exit(-1)
+
+import config     # user defined modules
+import util
+import prepswdl
+import indexswdl
+
+
+# ---------- #
+# Constants  #
+# ---------- #
+
+BENCH_ROWS = [10000, 100000, 1000000, 10000000]     # default number of rows to benchmark
+BENCH_DIR = "swdlbench"         # folder (under cwd) for results and benchmark charts
+BENCH_REPEAT = 3                # best of n timings (n=1 for 1M rows and over)
+BENCH_THRESHOLD = 20            # % slower than baseline flagged as a regression
+BENCH_MINSECS = 0.005           # ignore differences below timer noise
+
+BENCH_PERIODS = ['6D', '6W', '12W', '6M', '18M', 'allW', '6Q', 'allQ']     # periods plotted by main
+BENCH_PRODUCT = 'CMS'           # product grouped by release
+
+CHECK_ROWS = 20000              # synthetic rows used by the checks
+CHECK_QUERIES = 500             # random date range queries checked
+
+EXCEL_MAXROWS = 1048575         # data rows per worksheet (excluding header)
+
+# download filenames in the formats decode_filename understands
+SAMPLE_FILES = [('Server_2_9_1_vSphere-6_0.zip', 'CMS'),
+                ('Server_2_8_3.zip', 'CMS'),
+                ('Server_2_10_0_vSphere-6_5.ova', 'CMS'),
+                ('Server_3_1.tgz', 'CMS'),
+                ('Server_2_9.x.zip', 'CMS'),
+                ('App_1_11_4.exe', 'CMA'),
+                ('App_1_9_12.dmg', 'CMA'),
+                ('App_1.11.4.0.msi', 'CMA'),
+                ('111_2_0.msi', 'CMA'),
+                ('1_13_0_7.ipa', 'CMA'),
+                ('Management_2_5_0.ova', 'CMM'),
+                ('Management_2_6.ova', 'CMM')]
+
+# files removed by apply_filters (documents, unversioned installer)
+EXCLUDED_FILES = ['Cisco_Meeting_Server_Release_Notes.pdf', 'Cisco_Meeting.dmg']
+EXCLUDED_LEVELS = ['0 - Internal']
+
+FILE_FOLDER = '/swc/esd/'       # folder prefix of 'Full File Name'
+COMPANIES = ['Company {}'.format(i) for i in range(50)]
+
+
+#-------------------------------------------------------------
+# Original row-by-row filename decoder (reference for timings)
+#-------------------------------------------------------------
+def decode_filename_loop(df):
+
+    df_dict = {}
+    
+    # initialise decode_df
+    df_dict['Product'] = [None] * len(df)
+    df_dict['PType'] = [None] * len(df)
+    df_dict['R'] = [None] * len(df)
+    df_dict['V'] = [None] * len(df)
+    df_dict['M'] = [None] * len(df)
+    df_dict['Ext'] = [None] * len(df)
+    df_dict['Type'] = [None] * len(df)
+    df_dict['MonthYear'] = [None] * len(df)
+    
+    # split filename into columns (missing parts as None, whichever pandas version)
+    filesplit = pd.DataFrame(df.DownloadFile.str.split('_', n=4, expand=True)).reindex(columns=range(5))
+    filesplit = filesplit.astype(object).where(filesplit.notna(), None)
+    filesplit.columns = ['Product', 'R', 'V', 'M', 'Ext']
+
+
+    try:
+
+        for i in filesplit.index:
+
+            # assign ProductType and DownloadDate
+            df_dict['PType'][i] = df.Product[i]
+            df_dict['MonthYear'][i] = df.DownloadMonth[i]
+ 
+
+            # decode Product and 'R'
+            if filesplit.Product[i].isdigit(): 
+                df_dict['Product'][i] = 'Client'
+                df_dict['R'][i] = filesplit.Product[i]
+                df_dict['V'][i] = filesplit.R[i]
+                df_dict['M'][i] = filesplit.V[i]
+                df_dict['Ext'][i] = filesplit.M[i]
+            
+            else:
+                df_dict['Product'][i] = filesplit.Product[i]
+                if filesplit.R[i] is None:
+                    df_dict['R'][i] = '0'
+                else:
+                    df_dict['R'][i] = filesplit.R[i]  
+
+
+            # decode 'V'
+            if not filesplit.V[i] is None:
+
+                if df_dict['V'][i] is None:         # not already assigned from above
+
+                    if filesplit.V[i].isdigit():
+                        df_dict['V'][i] = filesplit.V[i]
+                    else:
+                        ver = filesplit.V[i].split('.')
+
+                        if len(ver) > 1:
+                            df_dict['V'][i] = ver[0]
+                            df_dict['Type'][i] = ver[1]
+                        else:
+                            df_dict['V'][i] = '0'
+                            
+            else:
+                df_dict['V'][i] = '0'
+
+
+            # decode 'M'
+            if not filesplit.M[i] is None:
+
+                if filesplit.M[i].isdigit():
+
+                    df_dict['M'][i] = filesplit.M[i]
+                
+                else:
+                    ver = filesplit.M[i].split('.')
+
+                    if ver[0].isdigit():
+                        df_dict['M'][i] = ver[0]
+                        df_dict['Type'][i] = ver[1]
+                    else:
+                        df_dict['M'][i] = '0'
+                        df_dict['Ext'][i] = ver[0]
+                        df_dict['Type'][i] = ver[1]
+                    
+            else:
+
+                if not df_dict['M'][i] is None:
+
+                    if not df_dict['M'][i].isdigit():
+                        ver = df_dict['M'][i].split('.')
+
+                        if ver[0].isdigit():
+                            df_dict['M'][i] = ver[0]
+                            df_dict['Type'][i] = ver[1]
+                        else:
+                            df_dict['M'][i] = '0'
+                            df_dict['Ext'][i] = ver[0]
+                            df_dict['Type'][i] = ver[1]
+
+                else:
+                    df_dict['M'][i] = '0'
+        
+
+            # decode 'Ext'
+            if not filesplit.Ext[i] is None:
+                ext = filesplit.Ext[i].split('.')
+                df_dict['Ext'][i] = ext[0]
+                df_dict['Type'][i] = ext[1]
+
+
+    except Exception as e:
+        print("Unable to decode file - {}".format(str(e)))
+
+    decode_df = pd.DataFrame(df_dict)
+    decode_df.reset_index(inplace=True)
+
+    return decode_df
+
+
+#-------------------------------------------------------------
+# Original month -> financial quarter loop (reference for checks)
+#-------------------------------------------------------------
+def get_month_fyq_loop(months):
+
+    fyq = ['']* len(months)
+    
+    for i, month in enumerate(months):
+        
+        mth, yr = month.split('-')      # separate into MMM and YY 
+        
+        for qtr, qtr_months in config.autokpi["fyq"].items():
+            if mth.upper() in qtr_months:
+                int_yr = int(yr)
+            
+                if qtr == 'Q1' or (qtr == 'Q2' and mth.upper() != 'JAN'):
+                    int_yr += 1
+
+                fyq_str = str.join('', ['FY', str(int_yr), ' ', qtr])
+                fyq[i] = fyq_str
+                break
+            
+    return fyq
+
+
+#-------------------------------------------------------------
+# Build synthetic downloads as passed to decode_filename
+# - returns DataFrame structure
+#-------------------------------------------------------------
+def make_downloads(nrows, seed=0):
+
+    rng = np.random.default_rng(seed)
+
+    pick = rng.integers(0, len(SAMPLE_FILES), nrows)
+    months = pd.date_range(prepswdl.SWDL_STARTDATE, periods=36, freq='MS').strftime("%b-%Y")
+
+    df = pd.DataFrame({'DownloadFile': [SAMPLE_FILES[i][0] for i in pick],
+                       'Product': [SAMPLE_FILES[i][1] for i in pick],
+                       'DownloadMonth': months[rng.integers(0, len(months), nrows)]})
+
+    return df
+
+
+#-------------------------------------------------------------
+# Build a synthetic SWDL export as returned by import_from_excel
+# - ~5% excluded files and ~10% excluded access levels
+# - download times from SWDL_STARTDATE to today
+# - returns DataFrame structure
+#-------------------------------------------------------------
+def make_import_frame(nrows, seed=0):
+
+    rng = np.random.default_rng(seed)
+
+    files = [''.join([FILE_FOLDER, 'Cisco_Meeting_', f]) for f, p in SAMPLE_FILES]
+    files += [''.join([FILE_FOLDER, f]) for f in EXCLUDED_FILES]
+    fileprob = np.r_[np.full(len(SAMPLE_FILES), 0.95 / len(SAMPLE_FILES)),
+                     np.full(len(EXCLUDED_FILES), 0.05 / len(EXCLUDED_FILES))]
+
+    levels = prepswdl.SWDL_TYPES + EXCLUDED_LEVELS
+    levelprob = np.r_[np.full(len(prepswdl.SWDL_TYPES), 0.9 / len(prepswdl.SWDL_TYPES)),
+                      np.full(len(EXCLUDED_LEVELS), 0.1 / len(EXCLUDED_LEVELS))]
+
+    start = pd.Timestamp(prepswdl.SWDL_STARTDATE)
+    secs = int((pd.Timestamp(date.today()) - start).total_seconds())
+
+    df = pd.DataFrame({'Full File Name': pd.Categorical.from_codes(rng.choice(len(files), nrows, p=fileprob), files),
+                       'Download Date and Time': start + pd.to_timedelta(np.sort(rng.integers(0, secs, nrows)), unit='s'),
+                       'Access Level Name': pd.Categorical.from_codes(rng.choice(len(levels), nrows, p=levelprob), levels),
+                       'User Id': rng.integers(0, max(nrows // 20, 1), nrows),
+                       'Company Name': pd.Categorical.from_codes(rng.integers(0, len(COMPANIES), nrows), COMPANIES)})
+
+    return df
+
+
+#-------------------------------------------------------------
+# Write a synthetic SWDL workbook
+# - rows beyond the Excel sheet limit go to further sheets
+#-------------------------------------------------------------
+def make_workbook(nrows, xlfile, xlsheet='SWDownloads-123', seed=0):
+
+    df = make_import_frame(nrows, seed)
+
+    with pd.ExcelWriter(xlfile) as writer:
+        for i, start in enumerate(range(0, nrows, EXCEL_MAXROWS)):
+            sheet = xlsheet if i == 0 else '-'.join([xlsheet, str(i+1)])
+            df.iloc[start:start+EXCEL_MAXROWS].to_excel(writer, sheet_name=sheet, index=False)
+
+    print("Workbook created: {0} ({1} rows)".format(xlfile, nrows))
+
+
+#-------------------------------------------------------------
+# Time a function call
+# - returns result, seconds
+#-------------------------------------------------------------
+def time_call(func, *args):
+
+    start = time.perf_counter()
+    result = func(*args)
+
+    return result, time.perf_counter() - start
+
+
+#-------------------------------------------------------------
+# Best of n timings of a function call
+# - returns result, seconds
+#-------------------------------------------------------------
+def time_best(repeat, func, *args):
+
+    result, best = time_call(func, *args)
+
+    for i in range(repeat - 1):
+        result, secs = time_call(func, *args)
+        best = min(best, secs)
+
+    return result, best
+
+
+#-------------------------------------------------------------
+# Time each pipeline stage on nrows of synthetic data
+# - charts are written under BENCH_DIR, not swdlout
+# - returns dict: stage -> seconds
+#-------------------------------------------------------------
+def bench_stages(nrows):
+
+    import plotswdl   # user defined module (imports matplotlib)
+
+    repeat = BENCH_REPEAT if nrows < 1000000 else 1
+    timings = {}
+
+    import_df = make_import_frame(nrows)
+
+    filter_df, timings['apply_filters'] = time_best(repeat, prepswdl.apply_filters, import_df)
+    swdl_df, timings['filter_downloads'] = time_best(repeat, prepswdl.filter_downloads, import_df, None)
+
+    decode_in = swdl_df[['DownloadFile', 'Product', 'DownloadMonth']]
+    decode_df, timings['decode_filename'] = time_best(repeat, prepswdl.decode_filename, decode_in)
+
+    counts_df, timings['build_daily_counts'] = time_best(repeat, prepswdl.build_daily_counts, swdl_df)
+
+    product_df = swdl_df[swdl_df.Product == BENCH_PRODUCT]
+
+    plots = {}
+    for period in BENCH_PERIODS:
+        stage = 'group_data_by_date[{}]'.format(period)
+        plots[period], timings[stage] = time_best(repeat, prepswdl.group_data_by_date, swdl_df, period)
+
+        stage = 'group_data_by_date[{0} {1}]'.format(BENCH_PRODUCT, period)
+        df_plot, timings[stage] = time_best(repeat, prepswdl.group_data_by_date, product_df, period, BENCH_PRODUCT)
+
+    outdir = os.path.join(BENCH_DIR, 'swdlout')
+
+    try:
+        chart, timings['plot_bar_chart'] = time_best(repeat, plotswdl.plot_bar_chart, plots['6M'], 'allProducts', '6M', outdir)
+        chart, timings['plot_stacked_chart'] = time_best(repeat, plotswdl.plot_stacked_chart, plots['allW'], 'allProducts', 'allW', outdir)
+    finally:
+        plotswdl.close_figures()
+
+    return timings
+
+
+#-------------------------------------------------------------
+# Run benchmarks and save results
+# - returns results filename
+#-------------------------------------------------------------
+def run_benchmarks(rows, outfile=None):
+
+    results = {"created": datetime.now().isoformat(timespec='seconds'),
+               "python": platform.python_version(),
+               "pandas": pd.__version__,
+               "numpy": np.__version__,
+               "timings": {}}
+
+    for nrows in rows:
+        timings = bench_stages(nrows)
+        results["timings"][str(nrows)] = timings
+
+        for stage, secs in timings.items():
+            print("{0:>9} rows  {1:<32} {2:10.4f}s".format(nrows, stage, secs))
+
+    if outfile is None:
+        stamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        outfile = os.path.join(BENCH_DIR, ''.join(['benchswdl-', stamp, '.json']))
+
+    os.makedirs(os.path.dirname(outfile) or '.', exist_ok=True)
+    with open(outfile, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print("Results saved: {}".format(outfile))
+
+    return outfile
+
+
+#-------------------------------------------------------------
+# Return most recent results file in BENCH_DIR
+#-------------------------------------------------------------
+def get_latest_results():
+
+    files = [f for f in os.listdir(BENCH_DIR) if f.startswith('benchswdl-') and f.endswith('.json')]
+
+    return os.path.join(BENCH_DIR, max(files))
+
+
+#-------------------------------------------------------------
+# Compare results with a saved baseline
+# - returns list of (rows, stage, baseline secs, secs) regressions
+#-------------------------------------------------------------
+def compare_results(basefile, resultfile, threshold=BENCH_THRESHOLD):
+
+    with open(basefile, 'r') as f:
+        baseline = json.load(f)["timings"]
+    with open(resultfile, 'r') as f:
+        current = json.load(f)["timings"]
+
+    print("Baseline: {0}\nResults:  {1}\n".format(basefile, resultfile))
+
+    regressions = []
+
+    for nrows, timings in current.items():
+        for stage, secs in timings.items():
+
+            base = baseline.get(nrows, {}).get(stage)
+            if base is None:
+                continue
+
+            slower = secs > base * (1 + threshold / 100) and secs - base > BENCH_MINSECS
+            if slower:
+                regressions.append((int(nrows), stage, base, secs))
+
+            print("{0:>9} rows  {1:<32} {2:10.4f}s {3:10.4f}s {4:+8.1f}%  {5}"
+                  .format(nrows, stage, base, secs, (secs / base - 1) * 100 if base else 0.0,
+                          'REGRESSION' if slower else ''))
+
+    print("\n{0} regression(s) over {1}%".format(len(regressions), threshold))
+
+    return regressions
+
+
+#-------------------------------------------------------------
+# Return True if two frames hold the same values (None/NaN
+# compare equal; dtypes are ignored)
+#-------------------------------------------------------------
+def same_values(df1, df2):
+
+    if list(df1.columns) != list(df2.columns) or len(df1) != len(df2):
+        return False
+
+    values1 = df1.astype(object).where(df1.notna(), None).values
+    values2 = df2.astype(object).where(df2.notna(), None).values
+
+    return bool((values1 == values2).all())
+
+
+#-------------------------------------------------------------
+# Compare vectorized decode_filename with original loop
+# - returns True if both decode the same values
+#-------------------------------------------------------------
+def bench_decode(nrows):
+
+    df = make_downloads(nrows)
+
+    loop_df, loop_secs = time_call(decode_filename_loop, df)
+    vect_df, vect_secs = time_call(prepswdl.decode_filename, df)
+
+    same = same_values(loop_df, vect_df)
+    print("decode_filename {0:>9} rows: loop {1:8.3f}s  vectorized {2:8.3f}s  speedup {3:6.1f}x  same: {4}"
+          .format(nrows, loop_secs, vect_secs, loop_secs / vect_secs, same))
+
+    return same
+
+
+#-------------------------------------------------------------
+# Raise AssertionError with message if a check fails
+#-------------------------------------------------------------
+def expect(passed, message):
+
+    if not passed:
+        raise AssertionError(message)
+
+
+#-------------------------------------------------------------
+# Check query_count against counting the downloads directly,
+# for raw downloads and daily counts over random date ranges
+#-------------------------------------------------------------
+def check_count_index():
+
+    rng = np.random.default_rng(1)
+
+    swdl_df = prepswdl.filter_downloads(make_import_frame(CHECK_ROWS), None)
+    counts_df = prepswdl.build_daily_counts(swdl_df)
+
+    index = indexswdl.build_count_index(swdl_df)
+    expect(np.array_equal(index["counts"], indexswdl.build_count_index(counts_df)["counts"]),
+           "index of daily counts differs from index of downloads")
+
+    days = pd.date_range(prepswdl.SWDL_STARTDATE - pd.Timedelta(days=30), date.today(), freq='D')
+    products = [None] + index["products"] + ['XXX']
+    releases = [None] + index["releases"] + ['0.0']
+
+    dates = swdl_df.DownloadDate.values
+    for i in range(CHECK_QUERIES):
+        start_dt, end_dt = sorted(days[rng.integers(0, len(days), 2)])
+        product = products[rng.integers(0, len(products))]
+        release = releases[rng.integers(0, len(releases))] if rng.random() < 0.5 else None
+
+        match = (dates >= start_dt.to_datetime64()) & (dates <= end_dt.to_datetime64())
+        if not product is None:
+            match &= (swdl_df.Product.astype(object) == product).values
+        if not release is None:
+            match &= (swdl_df.ReleaseNo.astype(object) == release).values
+
+        count = indexswdl.query_count(index, start_dt, end_dt, product, release)
+        expect(count == int(match.sum()), "query_count({0}, {1}, {2}, {3}) = {4}, expected {5}"
+               .format(start_dt.date(), end_dt.date(), product, release, count, int(match.sum())))
+
+    expect(indexswdl.query_count(index, days[-1], days[0]) == 0, "query_count of an empty range is not 0")
+
+
+#-------------------------------------------------------------
+# Check get_month_fyq, get_fyq_keys and get_date_fyq against
+# the original month loop, for every month 2010-2098 (the loop
+# writes years before 2010 as one digit e.g. 'FY5 Q1')
+#-------------------------------------------------------------
+def check_fyq():
+
+    dates = pd.Series(pd.date_range('2010-01-01', '2098-12-01', freq='MS'))
+    months = dates.dt.strftime("%b-%y").tolist()
+
+    expected = get_month_fyq_loop(months)
+    fyq = util.get_month_fyq(months)
+    expect(fyq == expected, "get_month_fyq differs from loop for {}".format(
+           [m for m, a, b in zip(months, fyq, expected) if a != b][:5]))
+
+    keys = util.get_fyq_keys(dates)
+    labels = ['FY{0:02d} Q{1}'.format((k // 4) % 100, k % 4 + 1) if k >= 0 else '' for k in keys]
+    expect(labels == expected, "get_fyq_keys differs from loop")
+
+    date_fyq = util.get_date_fyq(dates).astype(object).where(lambda s: s.notna(), '').tolist()
+    expect(date_fyq == expected, "get_date_fyq differs from loop")
+
+    expect(util.get_fyq_keys(pd.Series([pd.NaT]))[0] == -1, "get_fyq_keys of NaT is not -1")
+
+
+#-------------------------------------------------------------
+# Check record keys are the same however the export was read:
+# time unit, text timestamps, categorical or text columns, and
+# whatever other columns were exported
+#-------------------------------------------------------------
+def check_record_keys():
+
+    df = make_import_frame(1000)
+    keys = prepswdl.get_record_keys(df)
+
+    variants = {
+        'datetime64[us]': df.assign(**{'Download Date and Time': df['Download Date and Time'].astype('datetime64[us]')}),
+        'datetime64[s]': df.assign(**{'Download Date and Time': df['Download Date and Time'].astype('datetime64[s]')}),
+        'text times': df.assign(**{'Download Date and Time': df['Download Date and Time'].dt.strftime("%d/%m/%Y %H:%M:%S")}),
+        'object columns': df.astype({'Full File Name': object, 'Access Level Name': object, 'Company Name': object}),
+        'float user id': df.astype({'User Id': 'float64'}),
+        'column order': df[df.columns[::-1]],
+        'other columns': df.assign(**{'User Agent': 'Mozilla', 'Company Country': 'UK'}),
+    }
+
+    for name, variant in variants.items():
+        expect(np.array_equal(prepswdl.get_record_keys(variant), keys), "record keys differ for {}".format(name))
+
+    changed = df.assign(**{'Company Name': df['Company Name'].cat.rename_categories(lambda c: c + 'x')})
+    expect(not (prepswdl.get_record_keys(changed) == keys).any(), "record keys ignore user/company columns")
+
+
+#-------------------------------------------------------------
+# Check filter_unseen keeps exactly the records not seen
+#-------------------------------------------------------------
+def check_filter_unseen():
+
+    df = make_import_frame(2000)
+    keys = prepswdl.get_record_keys(df)
+
+    seen_keys = np.unique(prepswdl.get_record_keys(df.iloc[:1200]))
+    df_new = prepswdl.filter_unseen(df, seen_keys)
+    expect(df_new.index.equals(df.index[~np.isin(keys, seen_keys)]), "filter_unseen kept seen records")
+
+    # keys saved from a frame read with another time unit
+    df_us = df.assign(**{'Download Date and Time': df['Download Date and Time'].astype('datetime64[us]')})
+    expect(prepswdl.filter_unseen(df_us, seen_keys).index.equals(df_new.index), "filter_unseen depends on time unit")
+
+    expect(len(prepswdl.filter_unseen(df, np.unique(keys))) == 0, "filter_unseen kept records when all seen")
+    expect(len(prepswdl.filter_unseen(df, np.zeros(0, dtype=np.uint64))) == len(df), "filter_unseen dropped records when none seen")
+
+
+#-------------------------------------------------------------
+# Run the checks above
+# - returns number of checks failed
+#-------------------------------------------------------------
+def run_checks():
+
+    failed = 0
+
+    for check in [check_count_index, check_fyq, check_record_keys, check_filter_unseen]:
+        try:
+            check()
+            print("{0:<24} ok".format(check.__name__))
+        except AssertionError as e:
+            print("{0:<24} FAILED: {1}".format(check.__name__, str(e)))
+            failed += 1
+
+    return failed
+
+
+#***********#
+# M A I N   #
+#***********#
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+    command = args.pop(0) if args and not args[0].isdigit() else 'run'
+
+    outfile = None
+    if '--out' in args:
+        outfile = args.pop(args.index('--out')+1)
+        args.remove('--out')
+
+    threshold = BENCH_THRESHOLD
+    if '--threshold' in args:
+        threshold = float(args.pop(args.index('--threshold')+1))
+        args.remove('--threshold')
+
+    if command == 'run':
+        run_benchmarks([int(n) for n in args] or BENCH_ROWS, outfile)
+
+    elif command == 'compare':
+        resultfile = args[1] if len(args) > 1 else get_latest_results()
+        if compare_results(args[0], resultfile, threshold):
+            sys.exit(1)
+
+    elif command == 'workbook':
+        make_workbook(int(args[0]), args[1])
+
+    elif command == 'check':
+        if run_checks():
+            sys.exit(1)
+
+    elif command == 'decode':
+        results = [bench_decode(nrows) for nrows in [int(n) for n in args] or BENCH_ROWS[:2]]
+        if not all(results):
+            print("decode_filename differs from the original loop")
+            sys.exit(1)
+
+    else:
+        print(__doc__)
+        sys.exit(-1)
@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+
+"""********************************************************************
+Description:  Count index of downloads by day, product and release for
+              ad-hoc date range queries without regrouping the data
+
+              - build_count_index(df)
+              - save_count_index(index, outdir)
+              - load_count_index(outdir)
+              - query_count(index, start_dt, end_dt, product, release)
+
+              Usage: python indexswdl.py START END [PRODUCT [RELEASE]]
+                     e.g. python indexswdl.py 2019-01-01 2019-03-31 CMS 2.9
+
+***********************************************************************"""
+
+import os
+import sys
+
+try:
+    import numpy as np
+    import pandas as pd
+
+except ImportError:
+    print("Please install the python 'pandas' module")
+    sys.exit(-1)
+
+import util       # user defined modules
+import prepswdl
+import prodswdl
+
+
+# ---------- #
+# Constants  #
+# ---------- #
+
+INDEXFILE = "swdlindex.npz"     # saved with the charts/exports (see util.get_output_dir)
+
+
+# setup log
+swdllog = util.get_logger("swdllog")
+
+
+
+#-------------------------------------------------------------
+# Build cumulative download counts by day x product x release
+# from filter_downloads output (or daily counts: DownloadCnt)
+# - counts[d] holds downloads on days before start + d, so any
+#   date range is the difference of two rows
+# - returns dict: counts, start, products, releases
+#-------------------------------------------------------------
+def build_count_index(df):
+
+    products = prodswdl.get_product_codes()
+    releases = prepswdl.sort_releaseno_list(pd.unique(df.ReleaseNo.dropna().astype(str)).tolist())
+
+    if len(df) == 0:
+        return {"counts": np.zeros((1, len(products), len(releases)), dtype=np.int64),
+                "start": np.datetime64('NaT', 'D'), "products": products, "releases": releases}
+
+    days = df.DownloadDate.values.astype('datetime64[D]')
+    start = days.min()
+    day_idx = (days - start).astype(np.int64)
+    ndays = int(day_idx.max()) + 1
+
+    prod_idx = pd.Categorical(df.Product.astype(object), categories=products).codes
+    rel_idx = pd.Categorical(df.ReleaseNo.astype(object), categories=releases).codes
+
+    valid = (prod_idx >= 0) & (rel_idx >= 0)
+    if not valid.all():
+        swdllog.warning("Downloads not indexed (unknown product/release): {}".format(int((~valid).sum())))
+
+    flat = (day_idx * len(products) + prod_idx) * len(releases) + rel_idx
+
+    weights = df.DownloadCnt.values[valid] if "DownloadCnt" in df.columns else None
+    counts = np.bincount(flat[valid], weights=weights, minlength=ndays * len(products) * len(releases))
+    counts = counts.astype(np.int64).reshape(ndays, len(products), len(releases))
+
+    # prefix sums along days, with a leading row of zeros
+    cumulative = np.zeros((ndays + 1, len(products), len(releases)), dtype=np.int64)
+    np.cumsum(counts, axis=0, out=cumulative[1:])
+
+    swdllog.info("Count index: {0} days x {1} products x {2} releases".format(ndays, len(products), len(releases)))
+
+    return {"counts": cumulative, "start": start, "products": products, "releases": releases}
+
+
+#-------------------------------------------------------------
+# Return downloads between two dates (inclusive)
+# - product/release: None for all products/releases
+# - returns int
+#-------------------------------------------------------------
+def query_count(index, start_dt, end_dt, product=None, release=None):
+
+    counts = index["counts"]
+    ndays = counts.shape[0] - 1
+
+    if ndays == 0:
+        return 0
+
+    # days from start of index, clipped to the days held
+    first = int((np.datetime64(pd.Timestamp(start_dt).date(), 'D') - index["start"]).astype(np.int64))
+    last = int((np.datetime64(pd.Timestamp(end_dt).date(), 'D') - index["start"]).astype(np.int64))
+    first, last = max(first, 0), min(last, ndays - 1)
+
+    if first > last:
+        return 0
+
+    prod = slice(None)
+    if not product is None:
+        if not product in index["products"]:
+            return 0
+        prod = index["products"].index(product)
+
+    rel = slice(None)
+    if not release is None:
+        if not release in index["releases"]:
+            return 0
+        rel = index["releases"].index(release)
+
+    return int((counts[last + 1, prod, rel] - counts[first, prod, rel]).sum())
+
+
+#-------------------------------------------------------------
+# Return name of the saved count index
+# - outdir: folder of charts/exports (None: util.OUTPUT_DIR)
+# - returns string (filename)
+#-------------------------------------------------------------
+def get_index_filename(outdir=None):
+
+    return os.path.join(util.get_output_dir(outdir), INDEXFILE)
+
+
+#-------------------------------------------------------------
+# Save count index (atomically)
+# - returns string (filename), None if not saved
+#-------------------------------------------------------------
+def save_count_index(index, outdir=None):
+
+    indexfile = get_index_filename(outdir)
+
+    def dump(filename):
+        with open(filename, 'wb') as f:
+            np.savez_compressed(f, counts=index["counts"], start=np.array(index["start"]),
+                                products=np.array(index["products"], dtype=str),
+                                releases=np.array(index["releases"], dtype=str))
+
+    try:
+        util.write_file_atomic(indexfile, dump)
+    except Exception as e:
+        swdllog.warning("Could not save count index: {}".format(str(e)))
+        return None
+
+    swdllog.info("Saved count index: {}".format(indexfile))
+
+    return indexfile
+
+
+#-------------------------------------------------------------
+# Load a saved count index
+# - returns dict (None if not available)
+#-------------------------------------------------------------
+def load_count_index(outdir=None):
+
+    indexfile = get_index_filename(outdir)
+
+    if not os.path.exists(indexfile):
+        swdllog.warning("No count index found: {}".format(indexfile))
+        return None
+
+    try:
+        with np.load(indexfile) as data:
+            index = {"counts": data["counts"], "start": data["start"][()],
+                     "products": data["products"].tolist(), "releases": data["releases"].tolist()}
+
+    except Exception as e:
+        swdllog.warning("Could not read count index: {}".format(str(e)))
+        return None
+
+    return index
+
+
+
+#***********#
+# M A I N   #
+#***********#
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+
+    if len(args) < 2:
+        print(__doc__)
+        sys.exit(-1)
+
+    index = load_count_index()
+    if index is None:
+        print("No count index - run main.py --index first")
+        sys.exit(-1)
+
+    product = args[2] if len(args) > 2 else None
+    release = args[3] if len(args) > 3 else None
+
+    print(query_count(index, args[0], args[1], product, release))
@@ -12,9 +12,16 @@ Description:  Main script to automate KPI charts for 'Software Downloads'
 ********************************************************************"""
 
 import os
+import re
 import sys
+import glob
+import argparse
+import itertools
+
+from concurrent.futures import ProcessPoolExecutor
 
 try:
+    import numpy as np
     import pandas as pd
     import warnings
     
@@ -24,36 +31,62 @@ except ImportError as e:
 
 
 # user defined modules
+import config
 import util
-import plotswdl
 import prepswdl
+import storeswdl
+import prodswdl
+import indexswdl
 
 
 # --------- #
 # Constants #
 # --------- #
 
-PRODUCTS = {"CMS": "Cisco Meeting Server", "CMA": "Cisco Meeting App", "CMM": "Cisco Meeting Manager"}
-
 SWDLFILE = r'data\SWDL_data.xlsx'
 SWDLSHEET = r'SWDownloads-123'           
 
+ALL_PRODUCTS = "allProducts"                            # chart of all products
+ALLPRODUCT_PERIODS = ['18M', '6M', '6W', '6D', 'allW',  # periods charted for all products
+                      '{}Q'.format(config.autokpi["fyqs_to_plot"])]
+PRODUCT_PERIODS = ['12W', '18M', 'allW']                # periods charted for each product
+BAR_PERIODS = ['6M']                                    # all products periods charted as bars
+PERIOD_PATTERN = r'^(\d+|all)[DWMQ]$'                   # e.g. '6D', '12W', 'allW', '18M', '6Q'
+CHART_TYPES = ['bar', 'stacked']
+
+STREAM_CHUNKSIZE = 50000    # rows read per chunk when streaming the workbook
+CHART_WORKERS = 1           # processes used to render charts (1: render in this process)
+IMPORT_WORKERS = None       # processes used to import several sheets (None: one per CPU)
+ALL_SHEETS = '*'            # sheet name selecting every sheet of a workbook
+
+SWDLLOG = "swdllog.log"
+SWDLREPORT = "swdlreport.json"      # per-stage timings/memory of the last run (next to the log)
+
 # setup log
-swdllog = util.setup_logger("swdllog", "swdllog.log")
+swdllog = util.setup_logger("swdllog", SWDLLOG)
 
 
 
 #-------------------------------------------------------------
 # Import data from a defined sheet in a given Excel workbook
+# - reuses cached sheet unless workbook changed or refresh set
+# - reads only the columns used (see prepswdl.is_import_column)
 # - returns DataFrame structure 
 #-------------------------------------------------------------
-def import_from_excel(xlfile, xlsheet):
+def import_from_excel(xlfile, xlsheet, refresh=False):
 
     import_df = None
 
     if not xlfile or not xlsheet:
         swdllog.error("Excel filename and sheetname required for import")
         return import_df
+
+    if not refresh and os.path.exists(xlfile):
+        import_df = storeswdl.load_cached_sheet(xlfile, xlsheet)
+        if not import_df is None:
+            swdllog.info("Imported records (cached): {}".format(len(import_df)))
+            import_df = import_df[[c for c in import_df.columns if prepswdl.is_import_column(c)]]
+            return util.to_categorical(import_df, prepswdl.CATEGORY_COLUMNS)
     
     try:
     
@@ -61,7 +94,7 @@ def import_from_excel(xlfile, xlsheet):
         with warnings.catch_warnings():
             warnings.filterwarnings("ignore", category=PendingDeprecationWarning)
             warnings.filterwarnings("ignore", category=DeprecationWarning)
-            import_df = pd.read_excel(xlfile, xlsheet)
+            import_df = pd.read_excel(xlfile, xlsheet, usecols=prepswdl.is_import_column)
             
     except Exception as e:
         swdllog.error("Exception: {}".format(str(e)))
@@ -69,72 +102,460 @@ def import_from_excel(xlfile, xlsheet):
 
     if not import_df is None:
         swdllog.info("Imported records: {}".format(len(import_df)))
+        import_df = get_categorical(import_df)
+        storeswdl.save_cached_sheet(xlfile, xlsheet, import_df)
+
+    return import_df
+
+
+#-------------------------------------------------------------
+# Convert low cardinality columns to categoricals
+# - returns DataFrame structure 
+#-------------------------------------------------------------
+def get_categorical(import_df):
+
+    mem_before = util.get_memory_usage(import_df)
+    import_df = util.to_categorical(import_df, prepswdl.CATEGORY_COLUMNS)
+    mem_after = util.get_memory_usage(import_df)
+
+    swdllog.info("Memory usage: {0:.1f}MB -> {1:.1f}MB (categorical)".format(mem_before, mem_after))
 
     return import_df
 
 
+#-------------------------------------------------------------
+# Stream a sheet in chunks, keeping only rows that pass the
+# download filters (memory scales with rows kept)
+# - returns DataFrame structure 
+#-------------------------------------------------------------
+def stream_from_excel(xlfile, xlsheet, chunksize=STREAM_CHUNKSIZE):
+
+    import_df = None
+
+    if not xlfile or not xlsheet:
+        swdllog.error("Excel filename and sheetname required for import")
+        return import_df
+
+    try:
+        import openpyxl
+    except ImportError:
+        swdllog.error("Please install the python 'openpyxl' module to stream the workbook")
+        return import_df
+
+    try:
+
+        wb = openpyxl.load_workbook(xlfile, read_only=True, data_only=True)
+        rows = wb[xlsheet].iter_rows(values_only=True)
+        header = list(next(rows))
+        columns = [c for c in header if prepswdl.is_import_column(c)]
+        excluded = [c for c in header if not c in columns]
+
+        chunks = []
+        nrows = 0
+        while True:
+            chunk = list(itertools.islice(rows, chunksize))
+            if not chunk:
+                break
+
+            nrows += len(chunk)
+            chunk_df = pd.DataFrame.from_records(chunk, columns=header, exclude=excluded)
+
+            # keep raw columns only; derived columns are rebuilt by filter_downloads
+            chunk_df = prepswdl.apply_filters(chunk_df)[columns]
+            chunks.append(chunk_df)
+
+        wb.close()
+
+        import_df = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=columns)
+        import_df = get_categorical(import_df)
+
+    except Exception as e:
+        swdllog.error("Exception: {}".format(str(e)))
+        return None
+
+    swdllog.info("Streamed records: {0}; kept: {1}".format(nrows, len(import_df)))
+
+    return import_df
+
+
+#-------------------------------------------------------------
+# Import a single sheet, from the cache/workbook or streamed
+# - returns DataFrame structure
+#-------------------------------------------------------------
+def import_sheet(xlfile, xlsheet, refresh=False, streaming=False):
+
+    if streaming:
+        return stream_from_excel(xlfile, xlsheet)
+
+    return import_from_excel(xlfile, xlsheet, refresh)
+
+
+#-------------------------------------------------------------
+# Expand workbook names/globs and sheet names into the sheets
+# to import (sheet ALL_SHEETS: every sheet in the workbook)
+# - returns list of (workbook, sheet)
+#-------------------------------------------------------------
+def get_import_sources(xlfiles, xlsheets):
+
+    sources = []
+
+    for pattern in xlfiles:
+
+        pattern = os.path.join(os.getcwd(), pattern)
+        files = sorted(glob.glob(pattern)) or [pattern]     # missing file reported on import
+
+        for xlfile in files:
+            for xlsheet in xlsheets:
+
+                sheets = [xlsheet]
+                if xlsheet == ALL_SHEETS:
+                    try:
+                        with pd.ExcelFile(xlfile) as xl:
+                            sheets = xl.sheet_names
+                    except Exception as e:
+                        swdllog.error("Could not read sheets of {0}: {1}".format(xlfile, str(e)))
+                        continue
+
+                for sheet in sheets:
+                    if not (xlfile, sheet) in sources:
+                        sources.append((xlfile, sheet))
+
+    return sources
+
+
+#-------------------------------------------------------------
+# Import several sheets, across a pool of processes if
+# workers > 1, and combine them into one frame
+# - columns missing from a sheet are left empty
+# - returns DataFrame structure (None if nothing imported),
+#   number of sheets that failed to import
+#-------------------------------------------------------------
+def import_sources(sources, refresh=False, streaming=False, workers=IMPORT_WORKERS):
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    frames = []
+
+    if workers <= 1 or len(sources) <= 1:
+        for xlfile, xlsheet in sources:
+            frames.append(import_sheet(xlfile, xlsheet, refresh, streaming))
+    else:
+        swdllog.info("Importing {0} sheets across {1} processes .....".format(len(sources), workers))
+
+        with ProcessPoolExecutor(max_workers=min(workers, len(sources))) as pool:
+
+            futures = [pool.submit(import_sheet, xlfile, xlsheet, refresh, streaming) for xlfile, xlsheet in sources]
+
+            for (xlfile, xlsheet), future in zip(sources, futures):
+                try:
+                    frames.append(future.result())
+                except Exception as e:
+                    swdllog.error("Could not import {0} {1}: \n {2}".format(xlfile, xlsheet, str(e)))
+                    frames.append(None)
+
+    failed = len([f for f in frames if f is None])
+    if failed:
+        swdllog.warning("Sheets not imported (skipped): {0} of {1}".format(failed, len(sources)))
+
+    frames = [f for f in frames if not f is None]
+
+    if not frames:
+        return None, failed
+
+    if len(frames) == 1:
+        return frames[0], failed
+
+    # categories differ between sheets, so re-categorise after combining
+    import_df = pd.concat(frames, ignore_index=True, sort=False)
+    swdllog.info("Combined records from {0} sheets: {1}".format(len(frames), len(import_df)))
+
+    return get_categorical(import_df), failed
+
+
+#-------------------------------------------------------------
+# Merge downloads newer than the saved watermark into the
+# saved daily counts (rebuild ignores any saved state)
+# - track_seen: keep keys of the records counted, and count
+#   records not seen before rather than those after the watermark
+#   (so late records are counted and re-exported ones are not)
+# - returns Dataframe structure (daily counts)
+#-------------------------------------------------------------
+def update_daily_counts(import_df, rebuild=False, export_format=prepswdl.EXPORT_FORMAT, outdir=None,
+                        track_seen=False):
+
+    counts_df, watermark, seen_keys = None, None, None
+    if not rebuild:
+        counts_df, watermark = storeswdl.load_kpi_state()
+
+        if track_seen:
+            seen_keys = storeswdl.load_seen_keys()
+            if seen_keys is None and not counts_df is None:
+                swdllog.warning("Saved counts have no seen record keys - run with --rebuild to start keeping them")
+                track_seen = False
+
+    if seen_keys is None:
+        new_df = prepswdl.filter_after_watermark(import_df, watermark)
+    else:
+        new_df = prepswdl.filter_unseen(import_df, seen_keys)
+
+    # add to the saved export when adding to saved counts
+    if len(new_df) > 0:
+        new_df = prepswdl.filter_downloads(new_df, export_format, outdir, append=not counts_df is None)
+
+    if len(new_df) > 0:
+        with util.profile_stage("daily counts", new_df) as stage:
+            counts_df = prepswdl.merge_daily_counts([counts_df, prepswdl.build_daily_counts(new_df)])
+            stage["rows_out"] = len(counts_df)
+
+        new_watermark = prepswdl.get_download_times(new_df).max()
+        watermark = new_watermark if watermark is None else max(watermark, new_watermark)
+
+        if track_seen:
+            new_keys = prepswdl.get_record_keys(new_df)
+            seen_keys = np.unique(new_keys) if seen_keys is None else np.union1d(seen_keys, new_keys)
+
+        storeswdl.save_kpi_state(counts_df, watermark, seen_keys if track_seen else None)
+    else:
+        swdllog.info("No new downloads since last run")
+        counts_df = prepswdl.merge_daily_counts([counts_df])
+
+    return counts_df
+
+
+#-------------------------------------------------------------
+# List charts to produce, restricted to the given products,
+# periods and chart types (None: default charts)
+# - returns list of (chart type, product, period)
+#-------------------------------------------------------------
+def get_chart_plan(products=None, periods=None, chart_types=None):
+
+    plan = []
+
+    for product in [ALL_PRODUCTS] + prodswdl.get_product_codes():
+
+        if products and not product in products:
+            continue
+
+        if product == ALL_PRODUCTS:
+            product_periods = periods or ALLPRODUCT_PERIODS
+        else:
+            product_periods = periods or PRODUCT_PERIODS
+
+        for period in product_periods:
+
+            chart_type = 'stacked'
+            if product == ALL_PRODUCTS and period in BAR_PERIODS:
+                chart_type = 'bar'
+
+            if chart_types and not chart_type in chart_types:
+                continue
+
+            plan.append((chart_type, product, period))
+
+    return plan
+
+
 #-------------------------------------------------------------
 # Get data for downloads
+# - incremental: only process downloads since the last run
+# - products/periods/chart_types: subset of charts to produce
+# - data_format: write chart data as 'csv'/'json' tables instead
+#   of drawing charts (matplotlib is then never imported)
+# - index: save a count index for date range queries (indexswdl.py)
+# - xlfiles/xlsheets: workbook names/globs and sheets to import
+#   (None: SWDLFILE/SWDLSHEET)
 # - returns Dataframe structure
 #-------------------------------------------------------------
-def main():
+def main(xlfiles=None, xlsheets=None, outdir=None, products=None, periods=None, chart_types=None,
+         refresh=False, streaming=False, incremental=False, rebuild=False, workers=CHART_WORKERS, redraw=False,
+         export_format=prepswdl.EXPORT_FORMAT, data_format=None, import_workers=IMPORT_WORKERS, track_seen=False,
+         index=False):
 
-    xlfile = os.path.join(os.getcwd(), SWDLFILE)
+    xlfiles = xlfiles or [SWDLFILE]
+    xlsheets = xlsheets or [SWDLSHEET]
+
+    chart_plan = get_chart_plan(products, periods, chart_types)
+    if not chart_plan and not export_format and not index:
+        swdllog.warning("Nothing to produce for the selected products, periods and charts")
+        return
 
     # import data
-    import_df = import_from_excel(xlfile, SWDLSHEET)
+    with util.profile_stage("import") as stage:
+        sources = get_import_sources(xlfiles, xlsheets)
+        import_df, failed = import_sources(sources, refresh, streaming, import_workers)
+        stage["sources"] = len(sources)
+        stage["sources_failed"] = failed
+        stage["rows_out"] = util.get_row_count(import_df)
+
     if import_df is None:
         swdllog.warning("No download data available!")
         return
 
-    swdl_df = prepswdl.filter_downloads(import_df)
+    # count downloads per day/product/release once; all periods are rolled up from these
+    if incremental or rebuild:
+        swdl_df = update_daily_counts(import_df, rebuild, export_format, outdir, track_seen)
+    else:
+        swdl_df = prepswdl.filter_downloads(import_df, export_format, outdir)
+
+        with util.profile_stage("daily counts", swdl_df) as stage:
+            swdl_df = prepswdl.build_daily_counts(swdl_df)
+            stage["rows_out"] = len(swdl_df)
+
+    # index counts for ad-hoc date range queries (see indexswdl.py)
+    if index:
+        with util.profile_stage("count index", swdl_df):
+            indexswdl.save_count_index(indexswdl.build_count_index(swdl_df), outdir)
+
+    if not chart_plan:
+        return
     
+    chart_jobs = []     # (chart type, df_plot, product, period)
+
     #=============================
     # Plot KPIs for all Products
     #=============================
 
-    for period in ['18M', '6M', '6W', '6D', 'allW']:
+    for chart_type, product, period in chart_plan:
+
+        if product != ALL_PRODUCTS:
+            continue
        
-        df_plot = prepswdl.group_data_by_date(swdl_df, period)
+        with util.profile_stage(' '.join(["group", ALL_PRODUCTS, period]), swdl_df) as stage:
+            df_plot = prepswdl.group_data_by_date(swdl_df, period)
+            stage["rows_out"] = len(df_plot)
     
         swdllog.info("Plot KPI: All products for period {0}".format(period))
 
         # plot kpi as single/stacked bars
-        if period in ['18M', '6D', '6W', 'allW']:
-            kpi_chart = plotswdl.plot_stacked_chart(df_plot[['CMS','CMA','CMM']], "allProducts", period)
-        else:
-            kpi_chart = plotswdl.plot_bar_chart(df_plot[['CMS','CMA','CMM']], "allProducts", period)
+        df_plot = df_plot.reindex(columns=prodswdl.get_product_codes(), fill_value=0)
 
-        if kpi_chart:
-            swdllog.info("Chart created for all products: {0}".format(kpi_chart))
+        chart_jobs.append((chart_type, df_plot, ALL_PRODUCTS, period))
 
 
     #========================
     # Plot kpis by Product 
     #========================
 
-    for product in PRODUCTS:
-        
-        # filter data by product
-        pfilter = swdl_df.apply(lambda x: x.Product == product, axis=1)     
-        df_product = swdl_df[pfilter]
+    product_plan = [job for job in chart_plan if job[1] != ALL_PRODUCTS]
+
+    # split data by product in one pass (only if product charts requested)
+    product_dfs = prodswdl.partition_products(swdl_df) if product_plan else {}
+
+    for chart_type, product, period in product_plan:
+
+        df_product = product_dfs[product]
 
         if len(df_product) == 0:
-            swdllog.warning("No data found for {}".format(PRODUCTS[product]))
+            swdllog.warning("No data found for {0} {1}".format(prodswdl.get_product_name(product), period))
             continue 
 
-        for period in ['12W', '18M', 'allW']:
-           
+        with util.profile_stage(' '.join(["group", product, period]), df_product) as stage:
             df_plot = prepswdl.group_data_by_date(df_product, period, product)
+            stage["rows_out"] = len(df_plot)
   
-            kpi_chart = plotswdl.plot_stacked_chart(df_plot, product, period)
-            if kpi_chart:
-                swdllog.info("Chart created for {0} {1}: {2}".format(product, period, kpi_chart))
+        chart_jobs.append((chart_type, df_plot, product, period))
                         
+    #==========================
+    # Write chart data tables
+    #==========================
+
+    if data_format:
+        for chart_type, df_plot, product, period in chart_jobs:
+            datafile = prepswdl.write_plot_data(df_plot, product, period, data_format, outdir)
+            if datafile:
+                swdllog.info("Data written for {0} {1}: {2}".format(product, period, datafile))
+        return
+
+    #=============
+    # Plot charts
+    #=============
+
+    import plotswdl     # imports matplotlib only when charts are drawn
+
+    with util.profile_stage("charts") as stage:
+        charts = plotswdl.plot_charts(chart_jobs, workers, use_cache=not redraw, outdir=outdir)
+        stage["charts"] = len(chart_jobs)
+        stage["charts_created"] = len([c for p, d, c in charts if c])
+
+    for product, period, kpi_chart in charts:
+        if kpi_chart:
+            swdllog.info("Chart created for {0} {1}: {2}".format(product, period, kpi_chart))
+        else:
+            swdllog.warning("No chart created for {0} {1}".format(product, period))
 
     return
 
 
+#-------------------------------------------------------------
+# Check a period argument e.g. '6M', '12W', 'allW'
+# - returns string (period)
+#-------------------------------------------------------------
+def period_arg(period):
+
+    if not re.match(PERIOD_PATTERN, period):
+        raise argparse.ArgumentTypeError("invalid period '{}' (expected e.g. 6D, 12W, 18M, 6Q, allW; N is months "
+                                         "for D/W/M, quarters for Q)".format(period))
+
+    return period
+
+
+#-------------------------------------------------------------
+# Parse command line arguments
+# - returns argparse Namespace
+#-------------------------------------------------------------
+def parse_args(argv=None):
+
+    parser = argparse.ArgumentParser(description="Create KPI charts for Software Downloads")
+
+    parser.add_argument('-i', '--input', nargs='+', default=[SWDLFILE], metavar='WORKBOOK',
+                        help="Excel workbooks (names or globs) of downloads (default: {})".format(SWDLFILE))
+    parser.add_argument('-s', '--sheet', nargs='+', default=[SWDLSHEET], metavar='SHEET',
+                        help="sheets to import from each workbook, '{0}' for all (default: {1})".format(ALL_SHEETS, SWDLSHEET))
+    parser.add_argument('--import-workers', type=int, default=IMPORT_WORKERS, metavar='N',
+                        help="processes used to import several sheets (default: one per CPU)")
+    parser.add_argument('-o', '--outdir', default=None,
+                        help="folder for charts and exports (default: {})".format(util.OUTPUT_DIR))
+
+    parser.add_argument('-p', '--products', nargs='+', metavar='PRODUCT',
+                        choices=[ALL_PRODUCTS] + prodswdl.get_product_codes(),
+                        help="charts to produce: {} (default: all)".format(', '.join([ALL_PRODUCTS] + prodswdl.get_product_codes())))
+    parser.add_argument('--periods', nargs='+', type=period_arg, metavar='PERIOD',
+                        help="periods to chart as N or 'all' + D/W/M/Q (by day/week/month/financial quarter); "
+                             "N is months for D/W/M (e.g. 6D: days of the last 6 months, 12W: weeks of the last "
+                             "12 months) and quarters for Q (default: {0} for {1}, {2} by product)"
+                             .format(' '.join(ALLPRODUCT_PERIODS), ALL_PRODUCTS, ' '.join(PRODUCT_PERIODS)))
+    parser.add_argument('-c', '--charts', nargs='+', choices=CHART_TYPES, metavar='TYPE',
+                        help="chart types to produce: {} (default: all)".format(', '.join(CHART_TYPES)))
+
+    parser.add_argument('--refresh', action='store_true',
+                        help="re-import the workbook, ignoring any cached copy")
+    parser.add_argument('--stream', action='store_true',
+                        help="read the workbook in filtered chunks to limit memory use")
+    parser.add_argument('--incremental', action='store_true',
+                        help="add new downloads to the saved daily counts")
+    parser.add_argument('--rebuild', action='store_true',
+                        help="recreate the saved daily counts from the workbook")
+    parser.add_argument('--track-seen', action='store_true',
+                        help="with --incremental/--rebuild, keep keys of counted records and add records not "
+                             "seen before (including late ones) rather than those after the last run")
+    parser.add_argument('--workers', type=int, default=CHART_WORKERS,
+                        help="processes used to render charts (default: %(default)s)")
+    parser.add_argument('--redraw', action='store_true',
+                        help="redraw all charts, even if their data is unchanged")
+    parser.add_argument('--export', default=prepswdl.EXPORT_FORMAT, choices=['csv', 'csv.gz', 'parquet', 'none'],
+                        help="format of the decoded file details (default: %(default)s)")
+    parser.add_argument('--index', action='store_true',
+                        help="save a count index of downloads for date range queries (see indexswdl.py)")
+    parser.add_argument('--profile-memory', action='store_true',
+                        help="trace peak memory allocated by each stage in {} (about 8x slower charts)".format(SWDLREPORT))
+    parser.add_argument('--data-only', nargs='?', const=prepswdl.DATA_FORMAT, choices=['csv', 'json'],
+                        metavar='FORMAT', dest='data_format',
+                        help="write chart data as csv/json tables instead of charts (default: {})".format(prepswdl.DATA_FORMAT))
+
+    return parser.parse_args(argv)
+
+
 
 #***********#
 # M A I N   #
@@ -142,9 +563,21 @@ def main():
 
 if __name__ == "__main__":
     
+    args = parse_args()
+
     swdllog.info("Start Software Downloads automation.......")
 
-    main()
+    util.start_profiling(args.profile_memory)
+
+    try:
+        with util.profile_stage("run"):
+            main(xlfiles=args.input, xlsheets=args.sheet, outdir=args.outdir,
+                 products=args.products, periods=args.periods, chart_types=args.charts,
+                 refresh=args.refresh, streaming=args.stream, incremental=args.incremental,
+                 rebuild=args.rebuild, workers=args.workers, redraw=args.redraw,
+                 export_format=None if args.export == 'none' else args.export, data_format=args.data_format,
+                 import_workers=args.import_workers, track_seen=args.track_seen, index=args.index)
+    finally:
+        util.write_profile_report(os.path.join(os.path.dirname(os.path.abspath(SWDLLOG)), SWDLREPORT))
 
     swdllog.info("Finished!")
-    
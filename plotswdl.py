@@ -6,68 +6,100 @@ Created by:   Fiona Egbulefu (Contractor)
 Created date: 13 June 2019
 
 Description:  Plot KPI charts
+              - matplotlib is imported when the first chart is drawn
              
 ********************************************************************"""
 
 import os
 import sys
-import time
+import json
+import hashlib
+
+from concurrent.futures import ProcessPoolExecutor
 
 import util  # user defined
+import prodswdl
 
 try:
-    import xlrd
-    import numpy as np
     import pandas as pd
-
-    import matplotlib 
-    matplotlib.use('Agg')
-    
-    import matplotlib.pyplot as plt
-    import matplotlib.ticker as ticker
     
 except ImportError:
     print("Please make sure the following modules are installed: 'pandas'; 'matplotlib'")
     sys.exit(-1)
 
+# imported on first use (see load_matplotlib)
+matplotlib = None
+plt = None
+ticker = None
+
 
 # ---------- #
 # Constants  #
 # ---------- #
 
-PRODUCTS = {"CMS": "Cisco Meeting Server", "CMA": "Cisco Meeting App", "CMM": "Cisco Meeting Manager"}
-
-PRODCOLORS = {"CMS":('cornflowerblue','blue'), "CMA":('darkorange','gold'), "CMM":('darkgray', 'black')}
+PRODUCTS = prodswdl.PRODUCTS     # product codes, names and colors
 
 BARCOLORS = ['royalblue','darkorange','darkgray','gold','lightcoral','darkseagreen','navy','firebrick','mediumpurple']
 STACKCOLORS = ['royalblue','darkorange','darkgray','gold','cornflowerblue','darkseagreen','navy','firebrick','mediumpurple']
 
+CHARTSTYLE = 3                      # increase when chart layout changes to redraw cached charts
+CHARTCACHE = "swdlcharts.json"      # chart name -> key of data/style it was drawn with
+
+# per process: Cisco fonts loaded once, figures reused per (figsize, by_product)
+CUSTOM_FONTS = {}
+FIGURE_TEMPLATES = {}
+
         
 # setup log
 swdllog = util.get_logger("swdllog")
 
 
 #----------------------------------------------------------------
-# Setup Cisco fonts
+# Import matplotlib (once per process, only when charts are drawn)
+# - returns pyplot module
+#----------------------------------------------------------------
+def load_matplotlib():
+
+    global matplotlib, plt, ticker
+
+    if plt is None:
+        import matplotlib
+        matplotlib.use('Agg')
+
+        import matplotlib.pyplot as plt
+        import matplotlib.ticker as ticker
+
+    return plt
+
+
+#----------------------------------------------------------------
+# Setup Cisco fonts (loaded once per process)
 # - returns fontproperties object
 #----------------------------------------------------------------
-def get_custom_font():
+def get_custom_font(fontname="CiscoSansTTRegular.ttf"):
+
+    if fontname in CUSTOM_FONTS:
+        return CUSTOM_FONTS[fontname]
+
+    load_matplotlib()
 
     cwd = os.getcwd()
     
-    fontpath = os.path.join(cwd, "CiscoFonts", "CiscoSansTTRegular.ttf")
+    fontpath = os.path.join(cwd, "CiscoFonts", fontname)
+    matplotlib.font_manager.fontManager.addfont(fontpath)
     fontproperties = matplotlib.font_manager.FontProperties(fname=fontpath)
+
+    CUSTOM_FONTS[fontname] = fontproperties
     
     return fontproperties
 
    
 #----------------------------------------------------------------
-# Setup plot: label fonts and fontsize
-# return Plot Figure
+# Set figure size for chart
+# - returns tuple (width, height)
 #----------------------------------------------------------------
-def setup_plot(product, period, xlim, plot_type):
+def get_figsize(product, period, plot_type):
 
-    # set figsize
     if plot_type == 'bar':
 
         if product in PRODUCTS:
@@ -84,17 +116,67 @@ def setup_plot(product, period, xlim, plot_type):
             if 'all' in period:
                 figsize = (18,9)
 
-    # create plot
-    fig, ax = plt.subplots(figsize=figsize)
+    return figsize
 
-    custom_font = get_custom_font()     # use Cisco fonts
 
-    if product in PRODUCTS:
+#----------------------------------------------------------------
+# Get a cleared figure for the given size and chart style
+# - figures are created once and reused between charts; they stay
+#   open until close_figures() is called
+# - a reused figure is reset (axes and layout left by tight_layout)
+#   so it draws the same as a new one, whatever was drawn before
+# - returns Figure, Axes
+#----------------------------------------------------------------
+def get_figure(figsize, by_product):
+
+    load_matplotlib()
+
+    key = (figsize, by_product)
+
+    if key in FIGURE_TEMPLATES:
+        fig = FIGURE_TEMPLATES[key]
+        fig.clf()
+        fig.subplots_adjust(**{k: matplotlib.rcParams['figure.subplot.' + k]
+                               for k in ['left', 'right', 'bottom', 'top', 'wspace', 'hspace']})
+        plt.figure(fig.number)      # make figure current for plt calls
+        ax = fig.add_subplot()
+    else:
+        fig, ax = plt.subplots(figsize=figsize)
+        FIGURE_TEMPLATES[key] = fig
+
+    if by_product:
         ax.spines['right'].set_visible(False)
         ax.spines['top'].set_visible(False)
+
+    return fig, ax
+
+
+#----------------------------------------------------------------
+# Close all reusable figures
+#----------------------------------------------------------------
+def close_figures():
+
+    for fig in FIGURE_TEMPLATES.values():
+        plt.close(fig)
+
+    FIGURE_TEMPLATES.clear()
+
+
+#----------------------------------------------------------------
+# Setup plot: label fonts and fontsize
+# return Plot Figure
+#----------------------------------------------------------------
+def setup_plot(product, period, xlim, plot_type):
+
+    # get cleared plot
+    fig, ax = get_figure(get_figsize(product, period, plot_type), product in PRODUCTS)
+
+    custom_font = get_custom_font()     # use Cisco fonts
+
+    if product in PRODUCTS:
         ax.grid(True, which='major', axis='y', linestyle='-', alpha=0.4)
 
-        plt.title(PRODUCTS[product], color='darkgray', fontsize=16, fontproperties=custom_font)
+        plt.title(prodswdl.get_product_name(product), color='darkgray', fontsize=16, fontproperties=custom_font)
         
     else:
         plt.grid('on', linestyle='--', alpha=0.5)
@@ -111,18 +193,14 @@ def setup_plot(product, period, xlim, plot_type):
 
 #----------------------------------------------------------------
 # Derive chart name
+# - outdir: folder for charts (None: util.OUTPUT_DIR)
 # - returns string (filename)
 #----------------------------------------------------------------
-def get_filename(product, chartname):
+def get_filename(product, chartname, outdir=None):
 
-    cwd = os.getcwd()
     figname = ''.join(['SWDL_', product, '_', chartname, '.png'])
     
-    filename = os.path.join(cwd, 'swdlout', figname)
-
-    if os.path.exists(filename):
-        os.remove(filename)
-        time.sleep(2)   # make sure file is deleted 
+    filename = os.path.join(util.get_output_dir(outdir), figname)
 
     return filename
 
@@ -135,10 +213,10 @@ def get_custom_colormap(plot_type, index_range, product):
 ##    if product in PRODUCTS:
 ##        if product == 'CMS':
 ##            index_range -= 3
-##            colormap = [PRODCOLORS['CMS'][0]]*index_range + [PRODCOLORS['CMS'][1]]*3
+##            colormap = [PRODUCTS['CMS']['colors'][0]]*index_range + [PRODUCTS['CMS']['colors'][1]]*3
 ##        else:
 ##            index_range -= 1
-##            colormap = [PRODCOLORS[product][0]]*index_range + [PRODCOLORS[product][1]]
+##            colormap = [PRODUCTS[product]['colors'][0]]*index_range + [PRODUCTS[product]['colors'][1]]
 ##
 ##    else:
     if plot_type == 'bar':
@@ -165,9 +243,11 @@ def get_release_totals(df):
 
 #----------------------------------------------------------------
 # Plot bar chart for 6 months data
+# - the figure is reused, not closed: callers must call
+#   close_figures() when done (as plot_charts does)
 # - returns string (chart name)
 #----------------------------------------------------------------
-def plot_bar_chart(df, product, period):
+def plot_bar_chart(df, product, period, outdir=None):
     
     swdllog.info("Plotting bar chart {0} {1} .....".format(product, period))
 
@@ -234,10 +314,8 @@ def plot_bar_chart(df, product, period):
         plt.tight_layout()
 
         # save chart
-        savefile = get_filename(product, period)
-        fig.savefig(savefile)
-        
-        plt.close(fig)
+        savefile = get_filename(product, period, outdir)
+        util.write_file_atomic(savefile, fig.savefig)
 
     except Exception as e:
         
@@ -249,9 +327,11 @@ def plot_bar_chart(df, product, period):
 
 #----------------------------------------------------------------
 # Plot stack chart for all data
+# - the figure is reused, not closed: callers must call
+#   close_figures() when done (as plot_charts does)
 # - returns string (chart name)
 #----------------------------------------------------------------
-def plot_stacked_chart(df, product, period):
+def plot_stacked_chart(df, product, period, outdir=None):
     
     swdllog.info("Plotting stacked chart {0} {1} .....".format(product, period))
 
@@ -317,10 +397,8 @@ def plot_stacked_chart(df, product, period):
         plt.tight_layout()
 
         # save chart
-        savefile = get_filename(product, period)
-        fig.savefig(savefile)
-        
-        plt.close(fig)
+        savefile = get_filename(product, period, outdir)
+        util.write_file_atomic(savefile, fig.savefig)
 
 
     except Exception as e:
@@ -330,3 +408,148 @@ def plot_stacked_chart(df, product, period):
 
     return savefile
 
+
+#----------------------------------------------------------------
+# Plot a single chart job: (chart type, df, product, period)
+# - returns string (chart name)
+#----------------------------------------------------------------
+def plot_chart(job, outdir=None):
+
+    chart_type, df, product, period = job
+
+    if chart_type == 'bar':
+        return plot_bar_chart(df, product, period, outdir)
+
+    return plot_stacked_chart(df, product, period, outdir)
+
+
+#----------------------------------------------------------------
+# Plot a chart job, timing it with util.profile_stage
+# - returns string (chart name), profile record
+#----------------------------------------------------------------
+def profile_chart(job, outdir=None):
+
+    with util.profile_stage(' '.join(['chart', job[2], job[3]]), job[1]) as stage:
+        chartname = plot_chart(job, outdir)
+
+    return chartname, stage
+
+
+#----------------------------------------------------------------
+# Key a chart job on its data, chart type, period and styling
+# - returns string (sha1)
+#----------------------------------------------------------------
+def get_chart_key(job):
+
+    chart_type, df, product, period = job
+    plot_type = 'bar' if chart_type == 'bar' else 'stacked'
+
+    key = hashlib.sha1()
+    key.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+
+    style = [CHARTSTYLE, chart_type, product, period, get_figsize(product, period, plot_type),
+             BARCOLORS, STACKCOLORS, list(df.columns.astype(str)), list(df.dtypes.astype(str))]
+    key.update(json.dumps(style).encode())
+
+    return key.hexdigest()
+
+
+#----------------------------------------------------------------
+# Read chart cache (chart name -> chart key)
+# - returns dict
+#----------------------------------------------------------------
+def load_chart_cache(outdir=None):
+
+    cachefile = get_cache_filename(outdir)
+    if not os.path.exists(cachefile):
+        return {}
+
+    try:
+        with open(cachefile, 'r') as f:
+            return json.load(f)
+    except Exception as e:
+        swdllog.warning("Could not read chart cache: {}".format(str(e)))
+
+    return {}
+
+
+#----------------------------------------------------------------
+# Save chart cache (chart name -> chart key)
+#----------------------------------------------------------------
+def save_chart_cache(chart_cache, outdir=None):
+
+    def dump(filename):
+        with open(filename, 'w') as f:
+            json.dump(chart_cache, f, indent=2)
+
+    try:
+        util.write_file_atomic(get_cache_filename(outdir), dump)
+    except Exception as e:
+        swdllog.warning("Could not save chart cache: {}".format(str(e)))
+
+
+#----------------------------------------------------------------
+# Derive chart cache name
+# - returns string (filename)
+#----------------------------------------------------------------
+def get_cache_filename(outdir=None):
+
+    return os.path.join(util.get_output_dir(outdir), CHARTCACHE)
+
+
+#----------------------------------------------------------------
+# Plot chart jobs, across a pool of processes if workers > 1
+# - charts whose data and style are unchanged are not redrawn
+# - a failed chart does not stop the other charts
+# - returns list of (product, period, chart name)
+#----------------------------------------------------------------
+def plot_charts(jobs, workers=1, use_cache=True, outdir=None):
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    chart_cache = load_chart_cache(outdir) if use_cache else {}
+
+    results = {}
+    todo = []
+    for i, job in enumerate(jobs):
+        chartname = get_filename(job[2], job[3], outdir)
+        chartkey = get_chart_key(job)
+
+        if chart_cache.get(os.path.basename(chartname)) == chartkey and os.path.exists(chartname):
+            swdllog.info("Chart unchanged for {0} {1}: {2}".format(job[2], job[3], chartname))
+            results[i] = chartname
+        else:
+            chart_cache.pop(os.path.basename(chartname), None)
+            todo.append((i, job, chartname, chartkey))
+
+    swdllog.info("Chart cache hits: {0}; misses: {1}".format(len(results), len(todo)))
+
+    if workers <= 1 or len(todo) <= 1:
+        for i, job, chartname, chartkey in todo:
+            results[i], stage = profile_chart(job, outdir)
+        close_figures()
+    else:
+        swdllog.info("Plotting {0} charts across {1} processes .....".format(len(todo), workers))
+
+        with ProcessPoolExecutor(max_workers=min(workers, len(todo))) as pool:
+
+            futures = [pool.submit(profile_chart, job, outdir) for i, job, chartname, chartkey in todo]
+
+            for (i, job, chartname, chartkey), future in zip(todo, futures):
+                try:
+                    results[i], stage = future.result()
+                    util.PROFILE_RECORDS.append(stage)     # timed in the worker process
+                except Exception as e:
+                    swdllog.error("Could not create chart for {0} {1}: \n {2}".format(job[2], job[3], str(e)))
+                    results[i] = None
+
+    # remember keys of charts drawn successfully
+    for i, job, chartname, chartkey in todo:
+        if results[i]:
+            chart_cache[os.path.basename(chartname)] = chartkey
+
+    if todo:
+        save_chart_cache(chart_cache, outdir)
+
+    return [(job[2], job[3], results[i]) for i, job in enumerate(jobs)]
@@ -12,7 +12,6 @@ Description:  General routines to filter, format and prepare data for
 
 import os
 import sys
-import warnings
 
 from datetime import timedelta, datetime, date
 
@@ -24,7 +23,8 @@ except ImportError:
     print("Please install the python 'pandas' and 'xlrd' modules")
     sys.exit(-1)
 
-import util   # user defined module
+import util       # user defined modules
+import prodswdl
 
 
 # ---------- #
@@ -34,6 +34,28 @@ import util   # user defined module
 SWDL_STARTDATE = datetime(2016, 8, 1)   # start date used to process 'all' data
 SWDL_TYPES = ['1 - Registered Guest', '2 - Customer', '3 - Partner']
 
+DAILY_KEYS = ['DownloadDate', 'Product', 'ReleaseNo']     # keys of daily download counts
+
+# low cardinality columns carried as categoricals through the pipeline
+CATEGORY_COLUMNS = ['Full File Name', 'Access Level Name', 'DownloadFile', 'Product',
+                    'DownloadMonth', 'ReleaseNo', 'Ext', 'Type']
+
+CMS_RELEASE_LINES = 3       # CMS major.minor lines plotted by release; older lines are grouped
+
+# layouts of 'Download Date and Time' when exported as text
+DATETIME_FORMATS = ["%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M", "%d/%m/%Y",
+                    "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"]
+EXCEL_EPOCH = '1899-12-30'      # day 0 of Excel serial dates
+
+EXPORT_FORMAT = 'csv'           # decoded file details: 'csv', 'csv.gz' or 'parquet'
+DATA_FORMAT = 'csv'             # chart data tables (data-only runs): 'csv' or 'json'
+
+# columns identifying a download record, plus the user/company columns used when exported
+RECORD_COLUMNS = ['Download Date and Time', 'Full File Name', 'Access Level Name']
+RECORD_EXTRA = ['Company Name', 'User Id']
+
+RELEASE_PATTERN = r'^(?P<Major>\d+)(?:\.(?P<Minor>\d+))?(?:\.(?P<Maint>\d+))?$'     # e.g. '2.9' / '2.9.1'
+
 
 # setup log
 swdllog = util.get_logger("swdllog")
@@ -102,62 +124,60 @@ def sort_df_by_date(df, column, datefmt):
 
 
 #-------------------------------------------------------------
-# Returned sorted list by release numbers
+# Parse release numbers into (major, minor, maintenance) keys
+# e.g. '2.10' -> (2, 10, -1); parts not given are -1
+# - returns DataFrame structure (indexed by distinct release)
+#-------------------------------------------------------------
+def get_release_keys(releases):
+
+    releases = pd.Index(pd.unique(pd.Series(releases, dtype=object)))
+
+    parts = pd.Series(releases, dtype=object).str.extract(RELEASE_PATTERN)
+    keys = parts.apply(pd.to_numeric).fillna(-1).astype(np.int64)
+    keys.columns = ['Major', 'Minor', 'Maint']
+    keys.index = releases
+
+    # releases that are not numbers sort after all numbered releases
+    keys['Valid'] = parts.Major.notna().values
+
+    return keys
+
+
+#-------------------------------------------------------------
+# Returned sorted list by release numbers (major/minor/maint)
 #-------------------------------------------------------------
 def sort_releaseno_list(listnum):
 
-    tmp = None
-    for i in range(len(listnum)):
-        tmpi = int(''.join(listnum[i].split('.')))
-        
-        for j in range(i+1, len(listnum)):
-            tmpj = int(''.join(listnum[j].split('.')))
+    keys = get_release_keys(listnum).reindex(listnum)
+    order = np.lexsort((keys.Maint.values, keys.Minor.values, keys.Major.values, ~keys.Valid.values))
 
-            if tmpi > tmpj:
-                tmp = listnum[i]
-                listnum[i] = listnum[j]
-                listnum[j] = tmp
-            
-    #print("Sorted release:", listnum)
-    return listnum
+    return [listnum[i] for i in order]
 
 
 #-------------------------------------------------------------
 # Group CMS releases and identify major releases to plot
+# - newest 'keep_lines' major.minor lines are kept as released
+# - older releases are summed by line e.g. '2.1.x'
 # - returns DataFrame structure
 #-------------------------------------------------------------
-def group_cms_releases(df):
+def group_cms_releases(df, keep_lines=CMS_RELEASE_LINES):
 
-    minor_r = []
+    keys = get_release_keys(df.ReleaseNo).reindex(df.ReleaseNo)
 
-    # identify all minor releases and group under new release name
-    rcnt = 1
-    prev_r = None
-    
-    for i, release in enumerate(df.ReleaseNo.values.tolist()[::-1]):
-        split_r = release.split('.')
-
-        if i > 0:
-            if not (split_r[0] == prev_r[0] and split_r[1] == prev_r[1]):
-                rcnt += 1
-                if rcnt > 3:  
-                    minor_r.append('.'.join([split_r[0], split_r[1], 'x']))    # e.g. '2.1.x' 
-
-        prev_r = split_r
-        
-          
-    # sum minor releases then delete from df
-    minor_r_sum = {'ReleaseNo':[], 'ReleaseCnt':[]}
-    for r in minor_r[::-1]:
-        rfilter = df.ReleaseNo.map(lambda x: x.startswith(r[:-2]))
-        minor_r_sum['ReleaseNo'].append(r)
-        minor_r_sum['ReleaseCnt'].append(df[rfilter].ReleaseCnt.sum())
-        df = df[~rfilter]   # remove all minor releases
-
-    # append minor sums with grouped release names to df
-    df_minor_r = pd.DataFrame(minor_r_sum)
-    df = df_minor_r.append(df, ignore_index=True)
+    # rank major.minor lines (packed as one integer): 0 for newest line
+    line = pd.Series(keys.Major.values * 1000000 + keys.Minor.values, index=df.index)
+    line_rank = line.rank(method='dense', ascending=False).astype(np.int64) - 1
+
+    old = (line_rank >= keep_lines).values
+    df_old = df[old]
+    line_name = df_old.ReleaseNo.str.split('.').str[:2].str.join('.') + '.x'    # e.g. '2.1.x'
+
+    # sum older releases by line, oldest line first
+    df_minor_r = df_old.groupby([line_rank[old].values, line_name.values], sort=True).ReleaseCnt.sum()
+    df_minor_r = df_minor_r.sort_index(level=0, ascending=False).reset_index(level=0, drop=True)
+    df_minor_r = df_minor_r.rename_axis('ReleaseNo').reset_index()
 
+    df = pd.concat([df_minor_r, df[~old]], ignore_index=True)
 
     return df
 
@@ -176,8 +196,11 @@ def group_data_by_release(df, period, product):
         start_dt, end_dt = get_start_end_dates(-mths)
         df_data = df[(df.DownloadDate >= pd.to_datetime(start_dt)) & (df.DownloadDate <= pd.to_datetime(end_dt))]
    
-    df_grouped = df_data.groupby("ReleaseNo").size().reset_index(name="ReleaseCnt")
+    df_grouped = df_data.groupby("ReleaseNo", observed=True).size().reset_index(name="ReleaseCnt")
     df_grouped.fillna(0, inplace=True)
+
+    # order by release number e.g. '2.9' before '2.10'
+    df_grouped = df_grouped.set_index("ReleaseNo").loc[sort_releaseno_list(list(df_grouped.ReleaseNo))].reset_index()
     
     # group major releases for CMS
     if product == 'CMS':
@@ -194,67 +217,68 @@ def group_data_by_release(df, period, product):
 
    
 #-------------------------------------------------------------
-# Grroup data by week
-# - returns Dataframe structure
+# Return True/False for each valid release number e.g. '2.9'
+# - returns Series structure
+#-------------------------------------------------------------
+def is_valid_release(releases):
+
+    releases = releases.astype(object)
+    is_number = releases.str.replace('.', '', regex=False).str.isdigit().eq(True)
+    is_zero = releases.str.split('.').str[0].eq('0')     # not a valid number
+
+    return is_number & ~is_zero
+
+
+#-------------------------------------------------------------
+# Grroup data by week (Sun - Sat)
+# - each row is placed in its week by binary search on wkstart
+# - returns Dataframe structure (Product / ReleaseNo by week)
 #-------------------------------------------------------------
 def group_data_by_week(df, keydate, wkstart, wkend, keycol, keycnt):
 
-    grp_data = {}
-   
-    for idx, wk in enumerate(wkstart):      # by week
-        if not wk in grp_data:
-            grp_data[wk] = {}
-
-        for i in df.index:
-            dt = df[keydate][i].date()
-            key = df[keycol][i]
-
-            if keycol == "ReleaseNo":
-                if not key.replace('.','').isdigit() \
-                   or key.split('.')[0] == '0':         # not a valid number
-                    continue
-            
-            if not key in grp_data[wk]:    # by Product / ReleaseNo
-                grp_data[wk][key] = 0
-        
-            if (dt >= wk.date()) and (dt <= wkend[idx].date()):
-                grp_data[wk][key] += df[keycnt][i]
+    if keycol == "ReleaseNo":
+        df = df[is_valid_release(df[keycol])]
 
+    # every key is reported for every week, in order of first appearance
+    keys = pd.Index(pd.unique(df[keycol].astype(object)))
+    grp_data = np.zeros((len(keys), len(wkstart)), dtype=np.int64)
 
-    return grp_data
+    if len(wkstart) > 0 and len(df) > 0:
+        wkfrom = np.array(wkstart, dtype='datetime64[D]')
+        wkto = np.array(wkend, dtype='datetime64[D]')
+        dates = df[keydate].values.astype('datetime64[D]')
+
+        wk = np.searchsorted(wkfrom, dates, side='right') - 1
+        inweek = (wk >= 0) & (dates <= wkto[wk.clip(0)])
+
+        key = keys.get_indexer(df[keycol].astype(object))
+        np.add.at(grp_data, (key[inweek], wk[inweek]), df[keycnt].values[inweek].astype(np.int64))
+
+    return pd.DataFrame(grp_data, index=keys, columns=wkstart)
 
 
 #-------------------------------------------------------------
 # Group data by day/month
-# - returns dict
+# - returns Dataframe structure (Product / ReleaseNo by day/month)
 #-------------------------------------------------------------
 def group_data_by_day_month(df, keydate, keycol, keycnt):
 
-    grp_data = {}
-
-    for i in df.index:
-        dt = df[keydate][i]
-        key = df[keycol][i]
-
-        # check for valid releaseno's
-        if keycol == "ReleaseNo":
-            if not key.replace('.','').isdigit() \
-               or key.split('.')[0] == '0':         # not a valid number
-                continue
-
-        if not dt in grp_data:          # by day/month
-            grp_data[dt] = {}
-        if not key in grp_data[dt]:     # by product / releaseno
-            grp_data[dt][key] = 0
-                
-        grp_data[dt][key] += df[keycnt][i]
+    # check for valid releaseno's
+    if keycol == "ReleaseNo":
+        df = df[is_valid_release(df[keycol])]
 
+    # keys in order of first appearance (as for weeks)
+    keys = pd.unique(df[keycol].astype(object))
+    grp_data = df.groupby([keycol, keydate], observed=True)[keycnt].sum().unstack(keydate)
+    grp_data = grp_data.reindex(keys)
+    grp_data.index.name = None
+    grp_data.columns.name = None
               
     return grp_data
 
 
 #-------------------------------------------------------------
-# Grroup products by day/week/month
+# Grroup products by day/week/month/financial quarter (Q)
 # - returns Dataframe structure
 #-------------------------------------------------------------
 def group_data_by_date(df, period, product=None):
@@ -262,7 +286,21 @@ def group_data_by_date(df, period, product=None):
     df_data = df
 
     # set start/end of period
-    if period[-1] in ['D', 'M']:
+    if period[-1] == 'Q':
+
+        # financial quarters, up to the quarter of the previous month
+        fyq_keys = util.get_fyq_keys(df.DownloadDate)
+        in_period = fyq_keys >= 0
+
+        if not 'all' in period:
+            start_dt, end_dt = get_start_end_dates(0)
+            end_key = util.get_fyq_keys([end_dt])[0]
+            in_period &= (fyq_keys > end_key - int(period[:-1])) & (df.DownloadDate <= pd.to_datetime(end_dt)).values
+
+        df_data = df[in_period]
+        df_data = df_data.assign(DownloadFYQ=util.get_date_fyq(df_data.DownloadDate))
+
+    elif period[-1] in ['D', 'M']:
 
         if not 'all' in period:
             mths = int(period[:-1])-1
@@ -285,6 +323,8 @@ def group_data_by_date(df, period, product=None):
     keydate = "DownloadMonth"
     if period[-1] in ['D', 'W']:
         keydate = "DownloadDate"
+    elif period[-1] == 'Q':
+        keydate = "DownloadFYQ"
 
     if product:
         keycol = "ReleaseNo"
@@ -292,11 +332,15 @@ def group_data_by_date(df, period, product=None):
     else:
         keycol = "Product"
         keycnt = "ProductCnt"
-        
-    df_grp = df_data[[keydate, keycol]].groupby([keydate, keycol]).size().reset_index(name=keycnt)
+
+    # daily counts (see build_daily_counts) are summed, raw downloads counted
+    if "DownloadCnt" in df_data.columns:
+        df_grp = df_data.groupby([keydate, keycol], observed=True)["DownloadCnt"].sum().reset_index(name=keycnt)
+    else:
+        df_grp = df_data[[keydate, keycol]].groupby([keydate, keycol], observed=True).size().reset_index(name=keycnt)
 
     # reformat grouped data
-    if period[-1] in ['D', 'M']:
+    if period[-1] in ['D', 'M', 'Q']:
         grp_data = group_data_by_day_month(df_grp, keydate, keycol, keycnt)
     else:
         grp_data = group_data_by_week(df_grp, keydate, wkstart, wkend, keycol, keycnt)
@@ -318,6 +362,11 @@ def group_data_by_date(df, period, product=None):
         df_sorted = sort_df_by_date(dates, "Months", "%b-%Y")
         df_grouped = df_grouped[df_sorted.Months.values.tolist()]
 
+    elif period[-1] == 'Q':
+
+        # quarters (ordered categories) are already in date order
+        df_grouped.columns = [str(q) for q in df_grouped.columns]
+
     else:       
         # set columns to: 'dd-MMM - dd-MMM'
         datecols = []
@@ -343,36 +392,223 @@ def group_data_by_date(df, period, product=None):
     return df_grouped
    
 
+#-------------------------------------------------------------
+# Count downloads per day/product/release
+# - returns DataFrame structure
+#-------------------------------------------------------------
+def build_daily_counts(df):
+
+    counts = df.groupby(DAILY_KEYS, observed=True).size().reset_index(name="DownloadCnt")
+    counts = counts.assign(DownloadMonth=util.map_categorical(counts.DownloadDate, lambda d: d.dt.strftime("%b-%Y")))
+
+    return counts
+
+
+#-------------------------------------------------------------
+# Merge daily counts from several runs into one set of counts
+# - returns DataFrame structure
+#-------------------------------------------------------------
+def merge_daily_counts(counts_list):
+
+    counts_list = [c for c in counts_list if not c is None and len(c) > 0]
+    if not counts_list:
+        return pd.DataFrame(columns=DAILY_KEYS + ["DownloadCnt", "DownloadMonth"])
+
+    counts = pd.concat([c[DAILY_KEYS + ["DownloadCnt"]] for c in counts_list], ignore_index=True)
+    counts = counts.groupby(DAILY_KEYS, observed=True)["DownloadCnt"].sum().reset_index()
+    counts = counts.assign(DownloadMonth=util.map_categorical(counts.DownloadDate, lambda d: d.dt.strftime("%b-%Y")))
+    counts = util.to_categorical(counts, CATEGORY_COLUMNS)
+
+    return counts
+
+
+#-------------------------------------------------------------
+# Parse timestamps given as dates, Excel serial numbers or
+# strings (dd/mm/yyyy); each distinct value is parsed once
+# - unparseable timestamps are reported and set to NaT
+# - returns Series structure
+#-------------------------------------------------------------
+def parse_download_times(times):
+
+    if pd.api.types.is_datetime64_any_dtype(times):
+        return times
+
+    if pd.api.types.is_numeric_dtype(times):      # Excel serial date/time
+        parsed = pd.to_datetime(times, unit='D', origin=EXCEL_EPOCH, errors='coerce')
+    else:
+        codes, uniques = pd.factorize(times)
+        uniques = pd.Series(np.asarray(uniques, dtype=object))
+
+        is_date = uniques.map(lambda x: isinstance(x, (datetime, date))).astype(bool)
+        is_number = uniques.map(lambda x: isinstance(x, (int, float, np.number)) and not isinstance(x, bool)).astype(bool)
+        is_string = uniques.map(lambda x: isinstance(x, str)).astype(bool)
+
+        unique_dt = pd.Series(pd.NaT, index=uniques.index, dtype='datetime64[ns]')
+        unique_dt[is_date] = pd.to_datetime(uniques[is_date].tolist())
+        unique_dt[is_number] = pd.to_datetime(uniques[is_number].astype(float), unit='D', origin=EXCEL_EPOCH)
+
+        # try each layout on strings not yet parsed
+        strings = uniques[is_string].str.strip()
+        for datefmt in DATETIME_FORMATS:
+            todo = unique_dt.isna() & is_string
+            if not todo.any():
+                break
+            unique_dt[todo] = pd.to_datetime(strings[todo[is_string].values], format=datefmt, errors='coerce')
+
+        parsed = unique_dt.values[codes]
+        parsed[codes < 0] = np.datetime64('NaT')
+        parsed = pd.Series(parsed, index=times.index)
+
+    # report values that are present but not a recognised date
+    invalid = times.notna() & parsed.isna()
+    if invalid.any():
+        swdllog.warning("Unparseable download dates: {0} record(s) e.g. '{1}'".format(invalid.sum(), times[invalid].iloc[0]))
+
+    return parsed
+
+
+#-------------------------------------------------------------
+# Return download timestamps ('Download Date and Time')
+# - returns Series structure
+#-------------------------------------------------------------
+def get_download_times(df):
+
+    return parse_download_times(df['Download Date and Time'])
+
+
+#-------------------------------------------------------------
+# Keep only downloads after a given timestamp (watermark)
+# - returns DataFrame structure 
+#-------------------------------------------------------------
+def filter_after_watermark(df, watermark):
+
+    if watermark is None:
+        return df
+
+    df_new = df[get_download_times(df) > pd.to_datetime(watermark)]
+
+    swdllog.info("Records after {0}: {1}".format(watermark, len(df_new)))
+
+    return df_new
+
+
+#-------------------------------------------------------------
+# Fingerprint each download record as a 64 bit hash of its
+# identifying columns (RECORD_COLUMNS and any RECORD_EXTRA columns)
+# - timestamps are hashed once parsed, numbers as floats and other
+#   values as strings, so the same record hashes the same from
+#   any sheet
+# - times: parsed download times, if already known
+# - returns array (uint64)
+#-------------------------------------------------------------
+def get_record_keys(df, times=None):
+
+    extra = sorted(c for c in RECORD_EXTRA if c in df.columns)
+
+    # same time unit whichever way the timestamps were read
+    if times is None:
+        times = get_download_times(df)
+
+    key_df = pd.DataFrame({'Time': times.values.astype('datetime64[ns]')}, index=df.index)
+
+    for col in RECORD_COLUMNS[1:] + extra:
+        if not col in df.columns:
+            key_df[col] = None
+        elif pd.api.types.is_numeric_dtype(df[col]):
+            key_df[col] = df[col].astype('float64')
+        else:
+            key_df[col] = util.map_categorical(df[col], lambda s: s.astype(str))
+
+    return pd.util.hash_pandas_object(key_df, index=False).values
+
+
+#-------------------------------------------------------------
+# Mark repeats of a download record e.g. from overlapping exports
+# (the first occurrence is not marked)
+# - times: parsed download times, if already known
+# - keep: records passing the other filters (None: all); only
+#   repeats among these are counted as dropped
+# - returns array (bool)
+#-------------------------------------------------------------
+def get_duplicate_downloads(df, times=None, keep=None):
+
+    if len(df) == 0:
+        return np.zeros(0, dtype=bool)
+
+    duplicated = pd.Series(get_record_keys(df, times)).duplicated().values
+
+    dropped = int((duplicated if keep is None else duplicated & keep).sum())
+    if dropped:
+        swdllog.info("Duplicate records dropped: {}".format(dropped))
+
+    return duplicated
+
+
+#-------------------------------------------------------------
+# Return True for columns of the export used by the pipeline:
+# RECORD_COLUMNS and RECORD_EXTRA (for deduplication)
+# - used to read only these columns from the workbook
+#-------------------------------------------------------------
+def is_import_column(col):
+
+    return col in RECORD_COLUMNS or col in RECORD_EXTRA
+
+
+#-------------------------------------------------------------
+# Keep only downloads whose record keys are not in seen_keys
+# - seen_keys: sorted array of keys (see get_record_keys)
+# - returns DataFrame structure
+#-------------------------------------------------------------
+def filter_unseen(df, seen_keys):
+
+    if len(df) == 0 or len(seen_keys) == 0:
+        return df
+
+    keys = get_record_keys(df)
+    pos = np.minimum(np.searchsorted(seen_keys, keys), len(seen_keys) - 1)
+    seen = seen_keys[pos] == keys
+
+    df_new = df[~seen]
+
+    swdllog.info("Records not seen before: {}".format(len(df_new)))
+
+    return df_new
+
+
 #-------------------------------------------------------------
 # Filter data months and download type (as set above)
+# - all filters are combined into one mask, applied once
+# - duplicate records are dropped
 # - returns DataFrame structure 
 #-------------------------------------------------------------
 def apply_filters(df):
 
+    filename = df['Full File Name']
+
     # exclude pdf files
-    pdf = df['Full File Name'].map(lambda x: x.endswith('.pdf'))
-    df = df[~pdf]
+    keep = ~filename.str.endswith('.pdf').eq(True).values
 
     # exclude filenames with no version e.g. '../Cisco_Meeting.dmg'
-    invalidfile = df['Full File Name'].map(lambda x: x.endswith('Cisco_Meeting.dmg'))
-    df = df[~invalidfile]
+    keep &= ~filename.str.endswith('Cisco_Meeting.dmg').eq(True).values
     
     # set date filter
     start_dt = SWDL_STARTDATE
     end_dt = util.get_next_date(datetime(date.today().year, date.today().month, 1), 0, -1)  # end of prev. month
     swdllog.debug("Filter dates: {0} - {1}".format(start_dt, end_dt))
 
-    # get last 12 months of data
-    swd_date = pd.to_datetime(df['Download Date and Time'], format="%d/%m/%Y %HH:%MM:%SS", errors='coerce')
-    swd_date = swd_date.dt.normalize()  # display only date part
-    df = df.assign(DownloadDate=swd_date)
-    df_filtered = df[(df.DownloadDate >= pd.to_datetime(start_dt)) & (df.DownloadDate <= pd.to_datetime(end_dt))]
+    swd_time = get_download_times(df)
+    swd_date = swd_time.dt.normalize()  # display only date part
+    keep &= ((swd_date >= pd.to_datetime(start_dt)) & (swd_date <= pd.to_datetime(end_dt))).values
 
     # select only 'Customer' and 'Partner' records
-    access_level = df_filtered['Access Level Name'].apply(lambda x: x in SWDL_TYPES)
-    df_filtered = df_filtered[access_level]
+    keep &= df['Access Level Name'].isin(SWDL_TYPES).values
+
+    # drop records exported more than once (repeats share the outcome of the filters above)
+    keep &= ~get_duplicate_downloads(df, swd_time, keep)
 
-    df_filtered.reset_index(inplace=True)
+    df_filtered = df[keep].copy(deep=False)
+    df_filtered.index = pd.RangeIndex(len(df_filtered))
+    df_filtered["DownloadDate"] = swd_date.values[keep]
 
     swdllog.debug("Filtered records: {0}".format(len(df_filtered)))
     
@@ -380,121 +616,101 @@ def apply_filters(df):
 
 
 #-------------------------------------------------------------
-# Split filename into parts that can be identified for  
+# Split version part of filename on first '.' e.g. '1.exe' 
+# - returns Series (before '.'), Series (after '.')
 #-------------------------------------------------------------
-def decode_filename(df):
+def split_version(ver):
 
-    df_dict = {}
-    
-    # initialise decode_df
-    df_dict['Product'] = [None] * len(df)
-    df_dict['PType'] = [None] * len(df)
-    df_dict['R'] = [None] * len(df)
-    df_dict['V'] = [None] * len(df)
-    df_dict['M'] = [None] * len(df)
-    df_dict['Ext'] = [None] * len(df)
-    df_dict['Type'] = [None] * len(df)
-    df_dict['MonthYear'] = [None] * len(df)
+    parts = ver.str.split('.')
     
-    # split filename into columns
-    filesplit = pd.DataFrame(df.DownloadFile.str.split('_', 4, expand=True))
-    filesplit.columns = ['Product', 'R', 'V', 'M', 'Ext']
-    #filesplit.to_csv("filesplit.csv", sep=',')
-
-
-    try:
-
-        for i in filesplit.index:
-
-            # assign ProductType and DownloadDate
-            df_dict['PType'][i] = df.Product[i]
-            df_dict['MonthYear'][i] = df.DownloadMonth[i]
- 
+    return parts.str[0], parts.str[1]
 
-            # decode Product and 'R'
-            if filesplit.Product[i].isdigit(): 
-                df_dict['Product'][i] = 'Client'
-                df_dict['R'][i] = filesplit.Product[i]
-                df_dict['V'][i] = filesplit.R[i]
-                df_dict['M'][i] = filesplit.V[i]
-                df_dict['Ext'][i] = filesplit.M[i]
-            
-            else:
-                df_dict['Product'][i] = filesplit.Product[i]
-                if filesplit.R[i] is None:
-                    df_dict['R'][i] = '0'
-                else:
-                    df_dict['R'][i] = filesplit.R[i]  
-
-
-            # decode 'V'
-            if not filesplit.V[i] is None:
-
-                if df_dict['V'][i] is None:         # not already assigned from above
-
-                    if filesplit.V[i].isdigit():
-                        df_dict['V'][i] = filesplit.V[i]
-                    else:
-                        ver = filesplit.V[i].split('.')
-
-                        if len(ver) > 1:
-                            df_dict['V'][i] = ver[0]
-                            df_dict['Type'][i] = ver[1]
-                        else:
-                            df_dict['V'][i] = '0'
-                            
-            else:
-                df_dict['V'][i] = '0'
-
-
-            # decode 'M'
-            if not filesplit.M[i] is None:
-
-                if filesplit.M[i].isdigit():
-
-                    df_dict['M'][i] = filesplit.M[i]
-                
-                else:
-                    ver = filesplit.M[i].split('.')
-
-                    if ver[0].isdigit():
-                        df_dict['M'][i] = ver[0]
-                        df_dict['Type'][i] = ver[1]
-                    else:
-                        df_dict['M'][i] = '0'
-                        df_dict['Ext'][i] = ver[0]
-                        df_dict['Type'][i] = ver[1]
-                    
-            else:
-
-                if not df_dict['M'][i] is None:
-
-                    if not df_dict['M'][i].isdigit():
-                        ver = df_dict['M'][i].split('.')
-
-                        if ver[0].isdigit():
-                            df_dict['M'][i] = ver[0]
-                            df_dict['Type'][i] = ver[1]
-                        else:
-                            df_dict['M'][i] = '0'
-                            df_dict['Ext'][i] = ver[0]
-                            df_dict['Type'][i] = ver[1]
-
-                else:
-                    df_dict['M'][i] = '0'
-        
-
-            # decode 'Ext'
-            if not filesplit.Ext[i] is None:
-                ext = filesplit.Ext[i].split('.')
-                df_dict['Ext'][i] = ext[0]
-                df_dict['Type'][i] = ext[1]
 
+#-------------------------------------------------------------
+# Split filename into parts that can be identified for  
+# - each distinct filename is decoded once
+# - returns DataFrame structure
+#-------------------------------------------------------------
+def decode_filename(df):
 
-    except Exception as e:
-        swdllog.error("Unable to decode file - {}".format(str(e)))
+    codes, files = pd.factorize(df.DownloadFile)
+    files = np.asarray(files, dtype=object)
 
-    decode_df = pd.DataFrame(df_dict)
+    # split filename into columns
+    filesplit = pd.Series(files, dtype=object).str.split('_', n=4, expand=True)
+    filesplit = filesplit.reindex(columns=range(5))
+    filesplit.columns = ['Product', 'R', 'V', 'M', 'Ext']
+    filesplit = filesplit.astype(object).where(filesplit.notna(), None)
+
+    none = pd.Series([None] * len(files), dtype=object)
+    decode = pd.DataFrame({'Product': none, 'R': none, 'V': none, 'M': none, 'Ext': none, 'Type': none})
+
+    # rows that cannot be decoded are logged and left with blank parts
+    invalid = pd.Series(False, index=filesplit.index)
+
+    # decode Product and 'R' - files starting with a number are 'Client' files
+    client = filesplit.Product.str.isdigit().eq(True)
+    decode.loc[~client, 'Product'] = filesplit.Product
+    decode.loc[~client, 'R'] = filesplit.R.fillna('0')
+    decode.loc[client, 'Product'] = 'Client'
+    decode.loc[client, 'R'] = filesplit.Product
+    decode.loc[client, 'V'] = filesplit.R
+    decode.loc[client, 'M'] = filesplit.V
+    decode.loc[client, 'Ext'] = filesplit.M
+
+    # decode 'V' 
+    ver = filesplit.V
+    has_v = ver.notna() & decode.V.isna()
+    ver_digit = ver.str.isdigit().eq(True)
+    ver_dot = ver.str.contains('.', regex=False).eq(True)
+    ver0, ver1 = split_version(ver)
+
+    decode.loc[has_v & ver_digit, 'V'] = ver
+    decode.loc[has_v & ~ver_digit & ver_dot, 'V'] = ver0
+    decode.loc[has_v & ~ver_digit & ver_dot, 'Type'] = ver1
+    decode.loc[has_v & ~ver_digit & ~ver_dot, 'V'] = '0'
+    decode.loc[ver.isna(), 'V'] = '0'
+
+    # decode 'M' - from 'M' part, or 'M' already assigned for 'Client' files
+    ver = filesplit.M.where(filesplit.M.notna(), decode.M)
+    ver_digit = ver.str.isdigit().eq(True)
+    ver0, ver1 = split_version(ver)
+    ver0_digit = ver0.str.isdigit().eq(True)
+    has_m = ver.notna() & ~ver_digit
+
+    decode.loc[ver.isna(), 'M'] = '0'
+    decode.loc[ver_digit, 'M'] = ver
+    decode.loc[has_m & ver0_digit, 'M'] = ver0
+    decode.loc[has_m & ~ver0_digit, 'M'] = '0'
+    decode.loc[has_m & ~ver0_digit, 'Ext'] = ver0
+    decode.loc[has_m, 'Type'] = ver1
+    invalid |= has_m & ~ver0_digit & ver1.isna()
+
+    # decode 'Ext'
+    ver = filesplit.Ext
+    has_ext = ver.notna()
+    ver0, ver1 = split_version(ver)
+
+    decode.loc[has_ext, 'Ext'] = ver0
+    decode.loc[has_ext, 'Type'] = ver1
+    invalid |= has_ext & ver1.isna()
+
+    if invalid.any():
+        swdllog.error("Unable to decode {0} file(s) e.g. {1}".format(invalid.sum(), files[invalid.values][0]))
+    if (codes < 0).any():
+        swdllog.error("Unable to decode {} download(s) with no filename".format((codes < 0).sum()))
+
+    decode = decode.astype(object).where(decode.notna(), None)
+
+    # expand decoded filenames back to one row per download
+    decode = decode.reindex(codes)
+    decode.index = df.index
+    decode_df = pd.DataFrame({'Product': decode.Product, 'PType': df.Product.astype(object),
+                              'R': decode.R, 'V': decode.V, 'M': decode.M, 'Ext': decode.Ext,
+                              'Type': decode.Type, 'MonthYear': df.DownloadMonth.astype(object)})
+
+    decode_df = decode_df.sort_index().reset_index(drop=True)
+    decode_df = decode_df.astype(object).where(decode_df.notna(), None)
     decode_df.reset_index(inplace=True)
     
     swdllog.info("Downloadfile decoded records: {}".format(len(decode_df)))
@@ -503,7 +719,8 @@ def decode_filename(df):
 
 
 #-------------------------------------------------------------
-# Decode and reformat downloadfile and export to CSV  
+# Decode and reformat downloadfile for export
+# - returns DataFrame structure
 #-------------------------------------------------------------
 def get_export_downloadfile(df):
 
@@ -511,88 +728,175 @@ def get_export_downloadfile(df):
     decode_df = decode_filename(df)
 
     sep = "_"
-    prodversion = [''] * len(decode_df)
 
     # join columns for Product/Version
-    for i in decode_df.index:
-    
-        prodversion[i] = decode_df.Product[i] + sep + str(decode_df.R[i]) + sep + str(decode_df.V[i]) + sep + str(decode_df.M[i])
-
-        if not decode_df.Ext[i] is None:
-            prodversion[i] = prodversion[i] + sep + decode_df.Ext[i]
-
+    prodversion = decode_df.Product.astype(str) + sep + decode_df.R.astype(str) + sep \
+                  + decode_df.V.astype(str) + sep + decode_df.M.astype(str)
+    has_ext = decode_df.Ext.notna()
+    prodversion[has_ext] = prodversion[has_ext] + sep + decode_df.Ext[has_ext].astype(str)
 
     export_df["ProductVersion"] = prodversion
     export_df["Product"] = decode_df.PType
 
-    exts = list(set(decode_df.Ext.values.tolist()))     # get unique value of exts
-
-    # place extension in different columns
-    vsphere = [''] * len(decode_df)
+    # place extension in different columns; vSphere products in one column
+    exts = sorted(e for e in decode_df.Ext.dropna().unique() if e)     # get unique value of exts
+    is_vsphere = decode_df.Ext.str.contains('vSphere', regex=False).eq(True)
 
     for ext in exts:
-        if not ext: continue
-
-        if 'vSphere' in ext:    # concatenate VSphere products
-            ext_list = np.where(decode_df.Ext==ext, ext, '')
-            for i in range(len(vsphere)):
-                if not ext_list[i]: continue
-                vsphere[i] = ext_list[i]
-        else:
+        if not 'vSphere' in ext:
             export_df[ext] = np.where(decode_df.Ext==ext, ext, '')
 
-    # split vsphere column to get version
-    vsph_ver = [''] * len(decode_df)
-    for i in range(len(vsph_ver)):
-        if not vsphere[i]: continue
-        ver = vsphere[i].split('-')[1].split('_')
-        vsph_ver[i] = ''.join([ver[0], '.', ver[1]])
-        vsphere[i] = 'vSphere'
-        
-    export_df["vSphere"] = vsphere
+    # split vsphere extension to get version e.g. 'vSphere-6_0' -> '6.0'
+    ver = decode_df.Ext[is_vsphere].str.split('-').str[1].str.split('_')
+    vsph_ver = pd.Series('', index=decode_df.index, dtype=object)
+    vsph_ver[is_vsphere] = (ver.str[0] + '.' + ver.str[1]).fillna('')
+
+    export_df["vSphere"] = np.where(is_vsphere, 'vSphere', '')
     export_df["vSp#"] = vsph_ver
 
     # include Extension and major/minor version numbers
-    export_df["Extension"] = decode_df.Ext
+    export_df["Extension"] = decode_df.Ext.astype('category')
     export_df["R"] = decode_df.R
     export_df["V"] = decode_df.V
     export_df["M"] = decode_df.M
-    export_df["Type"] = decode_df.Type
+    export_df["Type"] = decode_df.Type.astype('category')
 
     # download month and year
-    export_df["DownloadMonth"] = decode_df.MonthYear.str.split('-').str[0]
-    export_df["DownloadYear"] = decode_df.MonthYear.str.split('-').str[1]
+    month_year = decode_df.MonthYear.str.split('-')
+    export_df["DownloadMonth"] = month_year.str[0]
+    export_df["DownloadYear"] = month_year.str[1]
 
     
     return export_df
 
+
+#-------------------------------------------------------------
+# Read decoded file details written by write_export_downloadfile
+# - returns DataFrame structure (None if not available)
+#-------------------------------------------------------------
+def read_export_downloadfile(exportfile, export_format=EXPORT_FORMAT):
+
+    if not os.path.exists(exportfile):
+        return None
+
+    try:
+        if export_format == 'parquet':
+            return pd.read_parquet(exportfile)
+
+        # as text, so rows are written back unchanged
+        return pd.read_csv(exportfile, sep=',', dtype=str, keep_default_na=False)
+
+    except Exception as e:
+        swdllog.warning("Could not read exported file details: {}".format(str(e)))
+        return None
+
+
+#-------------------------------------------------------------
+# Add decoded file details to those already exported
+# - extension columns of either frame are kept (in sorted order,
+#   as get_export_downloadfile); missing ones are left blank
+# - returns DataFrame structure
+#-------------------------------------------------------------
+def merge_export_downloadfile(prev_df, export_df):
+
+    lead = ['ProductVersion', 'Product']
+    tail = list(export_df.columns[export_df.columns.get_loc('vSphere'):])
+    exts = sorted((set(prev_df.columns) | set(export_df.columns)) - set(lead + tail))
+
+    merged_df = pd.concat([prev_df, export_df], ignore_index=True, sort=False)
+    merged_df[exts] = merged_df[exts].fillna('')
+
+    return merged_df[lead + exts + tail]
+
+
+#-------------------------------------------------------------
+# Write decoded file details in the given format
+# - 'csv', 'csv.gz' (gzip compressed) or 'parquet'
+# - outdir: folder to write to (None: util.OUTPUT_DIR)
+# - append: add to the details already exported (incremental runs)
+# - returns string (filename)
+#-------------------------------------------------------------
+def write_export_downloadfile(export_df, export_format=EXPORT_FORMAT, outdir=None, append=False):
+
+    exportfile = os.path.join(util.get_output_dir(outdir), '.'.join(["exportswdl", export_format]))
+
+    if append:
+        prev_df = read_export_downloadfile(exportfile, export_format)
+        if prev_df is None:
+            swdllog.warning("No exported file details to add to - exporting new downloads only")
+        else:
+            export_df = merge_export_downloadfile(prev_df, export_df)
+
+    if export_format == 'csv':
+        util.write_file_atomic(exportfile, lambda f: export_df.to_csv(f, sep=',', index=False))
+    elif export_format == 'csv.gz':
+        util.write_file_atomic(exportfile, lambda f: export_df.to_csv(f, sep=',', index=False, compression='gzip'))
+    elif export_format == 'parquet':
+        util.write_file_atomic(exportfile, lambda f: export_df.to_parquet(f, index=False))
+    else:
+        swdllog.error("Unknown export format: {}".format(export_format))
+        return None
+
+    swdllog.info("Exported file details: {}".format(exportfile))
+
+    return exportfile
+
+
+#-------------------------------------------------------------
+# Write the data of a chart (see group_data_by_date) as a table
+# - 'csv' or 'json' (list of records, one per date)
+# - counts are written as integers whichever the period (day/month
+#   groups are unstacked as floats)
+# - outdir: folder to write to (None: util.OUTPUT_DIR)
+# - returns string (filename)
+#-------------------------------------------------------------
+def write_plot_data(df_plot, product, period, data_format=DATA_FORMAT, outdir=None):
+
+    datafile = os.path.join(util.get_output_dir(outdir), ''.join(['SWDL_', product, '_', period, '.', data_format]))
+
+    df_data = df_plot.fillna(0).astype('int64').rename_axis('Period').reset_index()
+
+    try:
+        if data_format == 'csv':
+            util.write_file_atomic(datafile, lambda f: df_data.to_csv(f, sep=',', index=False))
+        elif data_format == 'json':
+            util.write_file_atomic(datafile, lambda f: df_data.to_json(f, orient='records', indent=2))
+        else:
+            swdllog.error("Unknown data format: {}".format(data_format))
+            return None
+
+    except Exception as e:
+        swdllog.error("Could not write data for {0} {1}: {2}".format(product, period, str(e)))
+        return None
+
+    return datafile
+
     
 #-------------------------------------------------------------
 # Filter, sort and group data by product - CMS / CMA / CMM 
+# - export_format: format of decoded file details (None: no export)
+# - outdir: folder for decoded file details (None: util.OUTPUT_DIR)
+# - append: add details to those already exported, rather than
+#   replacing them (import_df holds new downloads only)
 # - returns DataFrame structure 
 #-------------------------------------------------------------
-def filter_downloads(import_df):
+def filter_downloads(import_df, export_format=EXPORT_FORMAT, outdir=None, append=False):
 
     # Filter data 
-    df = apply_filters(import_df)
-
-    # work out product type - CMS / CMA / CMM
-    filename = df['Full File Name'].str.split('/').str[-1]
-    filename = filename.str.replace('Cisco_Meeting_', '')
-
-    product = [''] * len(filename)
-    for i in filename.index:
-        if 'Server' in filename[i]:
-            product[i] = 'CMS'
-        elif 'Management' in filename[i]:
-            product[i] = 'CMM'
-        else:
-            product[i] = 'CMA'
+    with util.profile_stage("filter", import_df) as stage:
+        df = apply_filters(import_df)
+        stage["rows_out"] = len(df)
+
+    # work out product type - CMS / CMA / CMM (once per distinct file)
+    filename = util.map_categorical(df['Full File Name'],
+                                    lambda f: f.str.split('/').str[-1].str.replace('Cisco_Meeting_', '', regex=False))
+
+    product = util.map_categorical(filename, prodswdl.match_products)
 
     df = df.assign(DownloadFile=filename, Product=product)
  
     # set download date as 'month-year'
-    download_month = df.DownloadDate.dt.strftime("%b-%Y")
+    download_month = util.map_categorical(df.DownloadDate, lambda d: d.dt.strftime("%b-%Y"))
     df = df.assign(DownloadMonth=download_month)
 
     # sort data by Download Date by File
@@ -604,13 +908,15 @@ def filter_downloads(import_df):
     swdllog.info("Cleaned data: {}".format(len(df)))
 
     # extract file details to file 
-    export_df = get_export_downloadfile(df[['DownloadFile', 'Product', 'DownloadMonth']])
-    exportfile = os.path.join(os.getcwd(), "swdlout", "exportswdl.csv")
-    export_df.to_csv(exportfile, sep=',', index=False)
+    with util.profile_stage("decode/export", df) as stage:
+        export_df = get_export_downloadfile(df[['DownloadFile', 'Product', 'DownloadMonth']])
+        if export_format and (len(export_df) > 0 or not append):
+            write_export_downloadfile(export_df, export_format, outdir, append)
+        stage["rows_out"] = len(export_df)
     
     # create 'ReleaseNo' column from export_df: R.V
     release = export_df.R.map(str) + "." + export_df.V.map(str)     # + "." + export_df.M.map(str)
-    df = df.assign(ReleaseNo=release) 
+    df = df.assign(ReleaseNo=release.astype('category')) 
     
    
     return df
@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+
+"""********************************************************************
+Description:  Registry of products reported by the Software Downloads
+              KPI automation
+
+              - get_product_codes()
+              - get_product_name(product)
+              - match_products(filenames)
+              - partition_products(df)
+
+***********************************************************************"""
+
+import sys
+
+try:
+    import numpy as np
+    import pandas as pd
+
+except ImportError:
+    print("Please install the python 'pandas' module")
+    sys.exit(-1)
+
+
+# ---------- #
+# Constants  #
+# ---------- #
+
+# products in display order:
+# - match:  text in download filename identifying the product (None: any other file)
+# - colors: (older releases, current releases)
+PRODUCTS = {"CMS": {"name": "Cisco Meeting Server", "match": "Server", "colors": ('cornflowerblue','blue')},
+            "CMA": {"name": "Cisco Meeting App", "match": None, "colors": ('darkorange','gold')},
+            "CMM": {"name": "Cisco Meeting Manager", "match": "Management", "colors": ('darkgray', 'black')}}
+
+
+
+#-------------------------------------------------------------
+# Return product codes in display order
+# - returns list
+#-------------------------------------------------------------
+def get_product_codes():
+
+    return list(PRODUCTS.keys())
+
+
+#-------------------------------------------------------------
+# Return product display name e.g. 'Cisco Meeting Server'
+# - returns string
+#-------------------------------------------------------------
+def get_product_name(product):
+
+    return PRODUCTS[product]["name"]
+
+
+#-------------------------------------------------------------
+# Work out product code for each download filename
+# - products are matched in registry order
+# - returns Series structure
+#-------------------------------------------------------------
+def match_products(filenames):
+
+    matched = [(code, p["match"]) for code, p in PRODUCTS.items() if p["match"]]
+    default = [code for code, p in PRODUCTS.items() if not p["match"]][0]
+
+    filenames = filenames.astype(object)
+    conditions = [filenames.str.contains(match, regex=False).eq(True).values for code, match in matched]
+
+    product = np.select(conditions, [code for code, match in matched], default=default)
+
+    return pd.Series(product, index=filenames.index, dtype=object)
+
+
+#-------------------------------------------------------------
+# Split downloads by product in a single pass
+# - returns dict (product code: DataFrame structure)
+#-------------------------------------------------------------
+def partition_products(df):
+
+    partitions = {code: df_product for code, df_product in df.groupby("Product", sort=False, observed=True)}
+
+    # products with no downloads get an empty DataFrame
+    return {code: partitions.get(code, df.iloc[:0]) for code in PRODUCTS}
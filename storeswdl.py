@@ -0,0 +1,347 @@
+#!/usr/bin/python3
+
+"""********************************************************************
+Description:  Routines to persist intermediate data between runs of the
+              Software Downloads KPI automation
+
+              - get_file_fingerprint(filename)
+              - load_cached_sheet(xlfile, xlsheet)
+              - save_cached_sheet(xlfile, xlsheet, df)
+              - load_kpi_state()
+              - save_kpi_state(counts_df, watermark, seen_keys)
+              - load_seen_keys()
+
+***********************************************************************"""
+
+import os
+import sys
+import json
+import hashlib
+
+try:
+    import numpy as np
+    import pandas as pd
+
+except ImportError:
+    print("Please install the python 'pandas' module")
+    sys.exit(-1)
+
+import util   # user defined module
+
+
+# ---------- #
+# Constants  #
+# ---------- #
+
+CACHEDIR = "swdlcache"          # folder (under cwd) holding cached workbook sheets
+HASH_BLOCKSIZE = 1024 * 1024    # read workbook in 1MB blocks when hashing
+KPISTATE = "swdlstate"          # daily counts + watermark kept for incremental runs
+
+# columnar format for cached sheets: parquet if pyarrow is installed, else pickle
+# (sheets with mixed type columns are always pickled, see get_sheet_format)
+try:
+    import pyarrow      # only checks pyarrow is available (used by pandas for parquet)
+    CACHE_FORMAT = "parquet"
+except ImportError:
+    CACHE_FORMAT = "pickle"
+
+
+# setup log
+swdllog = util.get_logger("swdllog")
+
+
+
+#-------------------------------------------------------------
+# Return fingerprint of a file: path, size, mtime and sha1
+# - returns dict
+#-------------------------------------------------------------
+def get_file_fingerprint(filename):
+
+    stat = os.stat(filename)
+
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCKSIZE), b''):
+            sha1.update(block)
+
+    fingerprint = {"path": os.path.abspath(filename),
+                   "size": stat.st_size,
+                   "mtime": stat.st_mtime,
+                   "sha1": sha1.hexdigest()}
+
+    return fingerprint
+
+
+#-------------------------------------------------------------
+# Return cache file names for a given workbook/sheet
+# - workbooks of the same name in different folders are kept apart
+# - cache_format: format of the data file (None: CACHE_FORMAT)
+# - returns data filename, meta filename
+#-------------------------------------------------------------
+def get_cache_filenames(xlfile, xlsheet, cache_format=None):
+
+    name = os.path.splitext(os.path.basename(xlfile))[0]
+    folder = hashlib.sha1(os.path.dirname(os.path.abspath(xlfile)).encode()).hexdigest()[:8]
+    basename = '_'.join([name, folder, xlsheet])
+
+    cachedir = os.path.join(os.getcwd(), CACHEDIR)
+    datafile = os.path.join(cachedir, '.'.join([basename, cache_format or CACHE_FORMAT]))
+    metafile = os.path.join(cachedir, '.'.join([basename, 'json']))
+
+    return datafile, metafile
+
+
+#-------------------------------------------------------------
+# Return format to cache a sheet in: CACHE_FORMAT, or pickle if
+# any text column also holds other values (e.g. Excel dates and
+# serial numbers), which parquet cannot store as they are
+# - returns string
+#-------------------------------------------------------------
+def get_sheet_format(df):
+
+    if CACHE_FORMAT != "parquet":
+        return CACHE_FORMAT
+
+    for col in df.columns[df.dtypes == object]:
+        values = df[col].dropna()
+        if not values.map(lambda x: isinstance(x, str)).all():
+            swdllog.info("Mixed types in column '{}' - caching sheet as pickle".format(col))
+            return "pickle"
+
+    return CACHE_FORMAT
+
+
+#-------------------------------------------------------------
+# Read a DataFrame saved by write_frame (format from extension)
+# - returns DataFrame structure
+#-------------------------------------------------------------
+def read_frame(datafile):
+
+    if datafile.endswith(".parquet"):
+        return pd.read_parquet(datafile)
+
+    return pd.read_pickle(datafile)
+
+
+#-------------------------------------------------------------
+# Write a DataFrame in the format of its extension (atomically)
+#-------------------------------------------------------------
+def write_frame(df, datafile):
+
+    if datafile.endswith(".parquet"):
+        util.write_file_atomic(datafile, lambda f: df.to_parquet(f, index=False))
+    else:
+        util.write_file_atomic(datafile, df.to_pickle)
+
+
+#-------------------------------------------------------------
+# Write a dict as JSON (atomically)
+#-------------------------------------------------------------
+def write_json(meta, metafile):
+
+    def dump(filename):
+        with open(filename, 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    util.write_file_atomic(metafile, dump)
+
+
+#-------------------------------------------------------------
+# Load a previously imported sheet if the workbook is unchanged
+# - returns DataFrame structure (None if no valid cache)
+#-------------------------------------------------------------
+def load_cached_sheet(xlfile, xlsheet):
+
+    datafile, metafile = get_cache_filenames(xlfile, xlsheet)
+
+    if not os.path.exists(metafile):
+        swdllog.info("No cached data for {0} {1}".format(xlfile, xlsheet))
+        return None
+
+    try:
+        with open(metafile, 'r') as f:
+            meta = json.load(f)
+
+        datafile, metafile = get_cache_filenames(xlfile, xlsheet, meta.get("format"))
+        if not os.path.exists(datafile):
+            swdllog.info("No cached data for {0} {1}".format(xlfile, xlsheet))
+            return None
+
+        key = get_file_fingerprint(xlfile)
+        key["sheet"] = xlsheet
+
+        if meta.get("key") != key:
+            swdllog.info("Workbook changed since last import - cache invalidated")
+            return None
+
+        cached_df = read_frame(datafile)
+
+    except Exception as e:
+        swdllog.warning("Could not read cached data: {}".format(str(e)))
+        return None
+
+    swdllog.info("Loaded cached data: {}".format(datafile))
+
+    return cached_df
+
+
+#-------------------------------------------------------------
+# Save an imported sheet with the fingerprint of its workbook
+# - returns True/False
+#-------------------------------------------------------------
+def save_cached_sheet(xlfile, xlsheet, df):
+
+    cache_format = get_sheet_format(df)
+    datafile, metafile = get_cache_filenames(xlfile, xlsheet, cache_format)
+
+    try:
+        os.makedirs(os.path.dirname(datafile), exist_ok=True)
+
+        key = get_file_fingerprint(xlfile)
+        key["sheet"] = xlsheet
+
+        write_frame(df, datafile)
+
+        # write meta last so a stale data file is never treated as valid
+        write_json({"key": key, "format": cache_format, "rows": len(df)}, metafile)
+
+        # remove any copy cached in the other format
+        for other_format in set(["parquet", "pickle"]) - set([cache_format]):
+            other_file = get_cache_filenames(xlfile, xlsheet, other_format)[0]
+            if os.path.exists(other_file):
+                os.remove(other_file)
+
+    except Exception as e:
+        swdllog.warning("Could not cache imported data: {}".format(str(e)))
+        return False
+
+    swdllog.info("Cached imported data: {}".format(datafile))
+
+    return True
+
+
+#-------------------------------------------------------------
+# Return filenames of the persisted KPI state
+# - data/keys filenames are stamped with the watermark and row
+#   count so the meta file always points at matching files
+# - returns data filename, meta filename, seen keys filename
+#-------------------------------------------------------------
+def get_state_filenames(watermark=None, rows=0):
+
+    cachedir = os.path.join(os.getcwd(), CACHEDIR)
+    stamp = pd.to_datetime(watermark).strftime("%Y%m%d%H%M%S") if not watermark is None else 'none'
+    stamp = '-'.join([stamp, str(rows)])
+
+    datafile = os.path.join(cachedir, '.'.join(['-'.join([KPISTATE, stamp]), CACHE_FORMAT]))
+    metafile = os.path.join(cachedir, '.'.join([KPISTATE, 'json']))
+    keysfile = os.path.join(cachedir, '.'.join(['-'.join([KPISTATE, 'keys', stamp]), 'npy']))
+
+    return datafile, metafile, keysfile
+
+
+#-------------------------------------------------------------
+# Load daily download counts and watermark of last run
+# - returns DataFrame structure, watermark (None if no state)
+#-------------------------------------------------------------
+def load_kpi_state():
+
+    datafile, metafile, keysfile = get_state_filenames()
+
+    if not os.path.exists(metafile):
+        swdllog.info("No saved KPI state - processing all downloads")
+        return None, None
+
+    try:
+        with open(metafile, 'r') as f:
+            meta = json.load(f)
+
+        counts_df = read_frame(os.path.join(os.path.dirname(metafile), meta["datafile"]))
+
+        watermark = pd.to_datetime(meta["watermark"])
+
+    except Exception as e:
+        swdllog.warning("Could not read KPI state: {}".format(str(e)))
+        return None, None
+
+    swdllog.info("Loaded KPI state: {0} counts up to {1}".format(len(counts_df), watermark))
+
+    return counts_df, watermark
+
+
+#-------------------------------------------------------------
+# Load keys of the download records already counted
+# - returns sorted array (None if not kept with the KPI state)
+#-------------------------------------------------------------
+def load_seen_keys():
+
+    datafile, metafile, keysfile = get_state_filenames()
+
+    if not os.path.exists(metafile):
+        return None
+
+    try:
+        with open(metafile, 'r') as f:
+            meta = json.load(f)
+
+        if not meta.get("keysfile"):
+            return None
+
+        seen_keys = np.load(os.path.join(os.path.dirname(metafile), meta["keysfile"]))
+
+    except Exception as e:
+        swdllog.warning("Could not read seen record keys: {}".format(str(e)))
+        return None
+
+    swdllog.info("Loaded seen record keys: {}".format(len(seen_keys)))
+
+    return seen_keys
+
+
+#-------------------------------------------------------------
+# Save daily download counts and watermark for next run
+# - seen_keys: sorted keys of records counted (None: not kept)
+# - returns True/False
+#-------------------------------------------------------------
+def save_kpi_state(counts_df, watermark, seen_keys=None):
+
+    rows = int(counts_df["DownloadCnt"].sum()) if "DownloadCnt" in counts_df.columns else len(counts_df)
+    datafile, metafile, keysfile = get_state_filenames(watermark, rows)
+
+    try:
+        os.makedirs(os.path.dirname(datafile), exist_ok=True)
+
+        prev_meta = {}
+        if os.path.exists(metafile):
+            with open(metafile, 'r') as f:
+                prev_meta = json.load(f)
+
+        # counts/keys first, then switch the meta file over to them
+        write_frame(counts_df, datafile)
+
+        meta = {"watermark": None if watermark is None else str(watermark),
+                "datafile": os.path.basename(datafile),
+                "rows": len(counts_df)}
+
+        if not seen_keys is None:
+            def dump_keys(filename):
+                with open(filename, 'wb') as f:
+                    np.save(f, seen_keys)
+
+            util.write_file_atomic(keysfile, dump_keys)
+            meta["keysfile"] = os.path.basename(keysfile)
+            meta["keys"] = len(seen_keys)
+
+        write_json(meta, metafile)
+
+        for prev in ["datafile", "keysfile"]:
+            prev_file = prev_meta.get(prev)
+            if prev_file and prev_file != meta.get(prev):
+                os.remove(os.path.join(os.path.dirname(metafile), prev_file))
+
+    except Exception as e:
+        swdllog.warning("Could not save KPI state: {}".format(str(e)))
+        return False
+
+    swdllog.info("Saved KPI state: {0} counts up to {1}".format(len(counts_df), watermark))
+
+    return True
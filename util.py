@@ -12,14 +12,29 @@ Description:  Generic script to store common modules:
               - get_kpi_months(start_dt, end_dt)
               - get_kpi_fyq_start_end(start_dt, end_dt)
               - get_month_fyq(months_df)
+              - get_fyq_lookup()
+              - get_date_fyq(dates)
+              - to_categorical(df, columns)
+              - map_categorical(series, func)
+              - get_memory_usage(df)
+              - write_file_atomic(filename, write_func)
+              - get_output_dir(outdir)
+              - profile_stage(stage, rows_in)
+              - write_profile_report(reportfile)
               - setup_logger(logname, logfile)
               - get_logger(logname)
 
 *******************************************************************************"""
 
 import os
+import sys
+import json
 import time
 import logging
+import tempfile
+import contextlib
+import tracemalloc
+import multiprocessing
 
 import config   # user defined
 
@@ -31,10 +46,28 @@ except ImportError:
     print("Please install the python 'pandas' and 'xlrd' modules")
     sys.exit(-1)
 
+try:
+    import resource     # not available on Windows
+except ImportError:
+    resource = None
+
+try:
+    import psutil       # optional: current memory of the process on any platform
+except ImportError:
+    psutil = None
+
 from datetime import datetime, date
 from dateutil.relativedelta import relativedelta
 
 
+OUTPUT_DIR = "swdlout"  # default folder (under cwd) for charts and exports
+
+MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+
+PROFILE_RECORDS = []    # stages timed in this process (see profile_stage)
+PROFILE_PEAKS = []      # traced memory peak of each open stage (outermost first)
+
+
 #------------------------------------------------------------------------
 # Return True/False if reporting end of FYQ 
 #------------------------------------------------------------------------
@@ -142,24 +175,78 @@ def get_kpi_fyq_start_end(start_dt, end_dt):
 #----------------------------------------------------------------------------
 def get_month_fyq(months):
 
-    fyq = ['']* len(months)
-    
-    for i, month in enumerate(months):
-        
-        mth, yr = month.split('-')      # separate into MMM and YY 
-        
-        for qtr, qtr_months in config.autokpi["fyq"].items():
-            if mth.upper() in qtr_months:
-                int_yr = int(yr)
-            
-                if qtr == 'Q1' or (qtr == 'Q2' and mth.upper() != 'JAN'):
-                    int_yr += 1
+    if len(months) == 0:
+        return []
 
-                fyq_str = str.join('', ['FY', str(int_yr), ' ', qtr])
-                fyq[i] = fyq_str
-                break
+    quarter, fy_offset = get_fyq_lookup()
+
+    # separate into MMM and YY
+    parts = pd.Series(list(months), dtype=object).str.split('-', n=1, expand=True)
+    mth = parts[0].str.upper().map({m: i+1 for i, m in enumerate(MONTHS)}).fillna(0).astype(int).values
+    yr = parts[1].astype(int).values
+
+    fyq = np.char.add(np.char.add('FY', (yr + fy_offset[mth]).astype(str)),
+                      np.char.add(' Q', quarter[mth].astype(str)))
             
-    return fyq
+    return np.where(quarter[mth] > 0, fyq, '').tolist()
+
+
+#----------------------------------------------------------------------------
+# Build month -> financial quarter lookup from config.autokpi["fyq"]
+# - Q1 and Q2 months (except JAN) belong to the next financial year
+# - returns quarter, year offset (arrays indexed by month 1-12; quarter 0
+#   for months not in any quarter)
+#----------------------------------------------------------------------------
+def get_fyq_lookup():
+
+    quarter = np.zeros(13, dtype=np.int64)
+    fy_offset = np.zeros(13, dtype=np.int64)
+
+    for qtr, qtr_months in config.autokpi["fyq"].items():
+        for mth in qtr_months:
+            month = MONTHS.index(mth.upper()) + 1
+            quarter[month] = int(qtr[1:])
+
+            if qtr == 'Q1' or (qtr == 'Q2' and mth.upper() != 'JAN'):
+                fy_offset[month] = 1
+
+    return quarter, fy_offset
+
+
+#----------------------------------------------------------------------------
+# Financial quarter of each date as a sortable key: FY * 4 + quarter - 1
+# - returns array (-1 where no date/quarter)
+#----------------------------------------------------------------------------
+def get_fyq_keys(dates):
+
+    quarter, fy_offset = get_fyq_lookup()
+
+    dates = pd.to_datetime(pd.Series(dates))
+    month = dates.dt.month.fillna(0).astype(int).values
+    year = dates.dt.year.fillna(0).astype(int).values
+
+    keys = (year + fy_offset[month]) * 4 + quarter[month] - 1
+
+    return np.where(quarter[month] > 0, keys, -1)
+
+
+#----------------------------------------------------------------------------
+# Financial quarter of each date, e.g. 'FY17 Q1' (as get_month_fyq)
+# - categories are in date order
+# - returns Series structure (categorical)
+#----------------------------------------------------------------------------
+def get_date_fyq(dates):
+
+    keys = get_fyq_keys(dates)
+
+    codes, uniques = pd.factorize(keys, sort=True)
+    valid = uniques >= 0
+    codes = np.where(valid[codes], codes - (~valid).sum(), -1) if len(codes) else codes
+
+    labels = ['FY{0:02d} Q{1}'.format((k // 4) % 100, k % 4 + 1) for k in uniques[valid]]
+
+    return pd.Series(pd.Categorical.from_codes(codes, categories=labels, ordered=True),
+                     index=dates.index if isinstance(dates, pd.Series) else None)
 
 
 #-------------------------------------------------------------
@@ -195,6 +282,232 @@ def get_kpi_codes(kpi_list):
     return out_kpi
 
 
+#-------------------------------------------------------------
+# Convert given columns (where present) to pandas categoricals
+# - returns DataFrame structure
+#-------------------------------------------------------------
+def to_categorical(df, columns):
+
+    convert = {col: 'category' for col in columns
+               if col in df.columns and df[col].dtype.name != 'category'}
+
+    if not convert:
+        return df
+
+    return df.astype(convert)
+
+
+#-------------------------------------------------------------
+# Apply a function to the distinct values of a column rather
+# than to every row e.g. strip folder from filename
+# - func is called with a Series of the distinct values
+# - returns Series structure (categorical, sorted categories)
+#-------------------------------------------------------------
+def map_categorical(series, func):
+
+    series = series.astype('category')
+    old_codes = series.cat.codes.values
+
+    new_codes, new_categories = pd.factorize(func(pd.Series(series.cat.categories)), sort=True)
+
+    if len(new_codes) > 0:
+        codes = np.where(old_codes >= 0, new_codes[old_codes], -1)
+    else:
+        codes = old_codes
+
+    return pd.Series(pd.Categorical.from_codes(codes, categories=new_categories), index=series.index)
+
+
+#-------------------------------------------------------------
+# Return memory used by a DataFrame (incl. strings) in MB
+# - returns float
+#-------------------------------------------------------------
+def get_memory_usage(df):
+
+    return df.memory_usage(deep=True).sum() / (1024 * 1024)
+
+
+#-------------------------------------------------------------
+# Write a file to a temporary file in the same folder, then
+# rename it over the target so it is never left half-written
+# - write_func is called with the temporary filename
+# - returns filename
+#-------------------------------------------------------------
+def write_file_atomic(filename, write_func):
+
+    folder, name = os.path.split(filename)
+    base, ext = os.path.splitext(name)
+
+    fd, tmpfile = tempfile.mkstemp(prefix='.'.join(['', base, '']), suffix=ext, dir=folder or None)
+    os.close(fd)
+
+    # mkstemp files are private; give the output the usual permissions
+    umask = os.umask(0)
+    os.umask(umask)
+
+    try:
+        write_func(tmpfile)
+        os.chmod(tmpfile, 0o666 & ~umask)
+        os.replace(tmpfile, filename)
+
+    except Exception:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+    return filename
+
+
+#-------------------------------------------------------------
+# Return folder for charts and exports (created if missing)
+# - outdir: None for OUTPUT_DIR under the current folder
+# - returns string (folder name)
+#-------------------------------------------------------------
+def get_output_dir(outdir=None):
+
+    if not outdir:
+        outdir = os.path.join(os.getcwd(), OUTPUT_DIR)
+
+    os.makedirs(outdir, exist_ok=True)
+
+    return outdir
+
+
+#-------------------------------------------------------------
+# Return number of rows in a DataFrame/Series (None otherwise)
+#-------------------------------------------------------------
+def get_row_count(data):
+
+    if data is None or not hasattr(data, '__len__'):
+        return None
+
+    return len(data)
+
+
+#-------------------------------------------------------------
+# Return peak resident memory of this process so far in MB
+# - returns float (None if not available)
+#-------------------------------------------------------------
+def get_peak_rss():
+
+    if resource is None:
+        return None
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if sys.platform == 'darwin':
+        return round(maxrss / (1024 * 1024), 2)     # bytes on macOS
+
+    return round(maxrss / 1024, 2)                  # KB on Linux
+
+
+#-------------------------------------------------------------
+# Return current resident memory of this process in MB
+# - psutil if installed, else /proc (Linux)
+# - returns float (None if not available)
+#-------------------------------------------------------------
+def get_current_rss():
+
+    try:
+        if not psutil is None:
+            rss = psutil.Process().memory_info().rss
+        else:
+            with open('/proc/self/statm', 'r') as f:
+                rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    except (OSError, ValueError, IndexError):
+        return None
+
+    return round(rss / (1024 * 1024), 2)
+
+
+#-------------------------------------------------------------
+# Start tracing memory allocations for profile_stage
+#-------------------------------------------------------------
+def start_profiling(trace_memory=True):
+
+    del PROFILE_RECORDS[:]
+    del PROFILE_PEAKS[:]
+
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+#-------------------------------------------------------------
+# Time a stage of the run: wall/cpu time, rows in/out, resident
+# memory at start/end of the stage and peak memory allocated
+# (when tracemalloc is tracing, see start_profiling)
+# - set rows_out on the yielded record before leaving the block;
+#   other counts (e.g. sheets, charts) go in fields of their own
+# - stages may be nested; an outer peak includes its inner stages
+# - yields dict (record appended to PROFILE_RECORDS)
+#-------------------------------------------------------------
+@contextlib.contextmanager
+def profile_stage(stage, rows_in=None):
+
+    record = {"stage": stage,
+              "rows_in": get_row_count(rows_in),
+              "rows_out": None}
+
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        mem_start, mem_peak = tracemalloc.get_traced_memory()
+        if PROFILE_PEAKS:
+            PROFILE_PEAKS[-1] = max(PROFILE_PEAKS[-1], mem_peak)
+        PROFILE_PEAKS.append(mem_start)
+        tracemalloc.reset_peak()
+
+    rss_start = get_current_rss()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    try:
+        yield record
+
+    finally:
+        record["wall_secs"] = round(time.perf_counter() - wall_start, 4)
+        record["cpu_secs"] = round(time.process_time() - cpu_start, 4)
+        record["peak_mb"] = None
+        if tracing:
+            mem_peak = max(PROFILE_PEAKS.pop(), tracemalloc.get_traced_memory()[1])
+            if PROFILE_PEAKS:
+                PROFILE_PEAKS[-1] = max(PROFILE_PEAKS[-1], mem_peak)
+            record["peak_mb"] = round((mem_peak - mem_start) / (1024 * 1024), 2)
+        record["rss_start_mb"] = rss_start
+        record["rss_end_mb"] = get_current_rss()
+        record["pid"] = os.getpid()
+
+        PROFILE_RECORDS.append(record)
+
+        logging.getLogger("swdllog").debug("Profile {0}: {1:.3f}s wall, {2:.3f}s cpu, rows {3} -> {4}"
+                                           .format(stage, record["wall_secs"], record["cpu_secs"],
+                                                   record["rows_in"], record["rows_out"]))
+
+
+#-------------------------------------------------------------
+# Write the stages timed in this run as JSON
+# - returns True/False
+#-------------------------------------------------------------
+def write_profile_report(reportfile):
+
+    report = {"created": datetime.now().isoformat(timespec='seconds'),
+              "pid": os.getpid(),
+              "peak_rss_mb": get_peak_rss(),
+              "stages": PROFILE_RECORDS}
+
+    def dump(filename):
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    try:
+        write_file_atomic(reportfile, dump)
+    except Exception as e:
+        logging.getLogger("swdllog").warning("Could not write run report: {}".format(str(e)))
+        return False
+
+    return True
+
+
 #-------------------------------------------------------------
 # Get logger
 # - returns log handler 
@@ -210,14 +523,10 @@ def get_logger(logname):
 #-------------------------------------------------------------
 def setup_logger(logname, logfile):
 
-    # delete existing log file
-    log = os.path.join(os.getcwd(), logfile)
-    if os.path.exists(log):
-        try:
-            os.remove(log)
-            time.sleep(2)
-        except Exception as e:
-            print("WARNING - Could not delete {}; Log will be appended.".format(logfile))
+    # start a new log file, unless in a worker process sharing the log
+    mode = 'w'
+    if multiprocessing.current_process().name != 'MainProcess':
+        mode = 'a'
 
     # setup log file
     logger = logging.getLogger(logname)
@@ -227,7 +536,7 @@ def setup_logger(logname, logfile):
     log_format = logging.Formatter(formatter, datefmt="%d-%b-%y %H:%M:%S")
 
     # setup file handler
-    log_hndlr = logging.FileHandler(logfile, 'a')
+    log_hndlr = logging.FileHandler(logfile, mode)
     log_hndlr.setLevel(logging.DEBUG)
     log_hndlr.setFormatter(log_format)
 